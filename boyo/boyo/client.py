@@ -2,43 +2,85 @@
 import boto
 from boto.s3 import connection as s3_connection
 from boto.exception import S3ResponseError as s3_error
-from keystoneclient.v2_0 import client as key_v2
 
+import hashlib
+import itertools
 import logging
+from multiprocessing.pool import ThreadPool
 import os
-from urlparse import urlparse
+import sys
+import threading
+
+from openderp.auth import CACHE_DIR, CachedAuth, Ec2Cache, ec2_settings
+from openderp.multipart import MultipartUploader, plan_parts
+
+from boyo.transfer import CHUNK_SIZE, RANGE_SIZE, ETagHash, iter_key, plan_ranges
 
 log = logging.getLogger(__name__)
 
+# Most keys s3 allows in one multi object delete
+DELETE_BATCH_SIZE = 1000
+# Files larger than this are uploaded in parts
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+
 class BoyoClient(object):
     def __init__(self, username, password, tenant_name, auth_url):
         '''Args correspond to OpenStack auth args'''
-        # Get "ec2" creds from keystone
-        keystone = key_v2.Client(username=username,
-                                 password=password,
-                                 tenant_name=tenant_name,
-                                 auth_url=auth_url)
-        creds = keystone.ec2.list(keystone.user_id)
-        if len(creds) == 0:
-            keystone.ec2.create(keystone.user_id, keystone.tenant_id)
-            creds = keystone.ec2.list(keystone.user_id)
-        cred = creds[-1]
+        # Get "ec2" creds, only go to keystone if not cached from last run
+        self.ec2_cache = Ec2Cache(username, tenant_name, auth_url)
+        settings = self.ec2_cache.get()
+        if not settings:
+            keystone = CachedAuth(username, password, tenant_name,
+                                  auth_url).keystone
+            settings = ec2_settings(keystone)
+            self.ec2_cache.set(settings)
+        self.settings = settings
         # use to create s3 connection
-        s3_url = urlparse(keystone.service_catalog.url_for(
-                    service_type='object-store'))
-        host, port = s3_url.netloc.split(':')
-        self.boto = boto.connect_s3(aws_access_key_id=cred.access,
-                                    aws_secret_access_key=cred.secret,
-                                    host=host,
-                                    port=int(port),
-                                    is_secure=False,
-                                    calling_format=s3_connection.OrdinaryCallingFormat())
-
-    def list(self, bucket_name=None):
+        self.boto = self.connect()
+        # Connections for worker threads, boto connections are not shareable
+        self.__local = threading.local()
+        # Cleared once proxy turns out not to support multi object delete
+        self.multi_delete = True
+
+    def connect(self):
+        '''Create a new s3 connection'''
+        return boto.connect_s3(aws_access_key_id=self.settings['access'],
+                               aws_secret_access_key=self.settings['secret'],
+                               host=self.settings['host'],
+                               port=self.settings['port'],
+                               is_secure=False,
+                               calling_format=s3_connection.OrdinaryCallingFormat())
+
+    def __thread_bucket(self, bucket_name):
+        # Bucket on a connection owned by the calling thread
+        if not getattr(self.__local, 'connection', None):
+            self.__local.connection = self.connect()
+        return self.__local.connection.get_bucket(bucket_name, validate=False)
+
+    def __check_forbidden(self, error):
+        # Cached credentials might have been removed from keystone
+        if error.status == 403:
+            log.error('Access denied, removing cached ec2 credentials')
+            self.ec2_cache.invalidate()
+
+    def iter_keys(self, bucket, prefix='', delimiter='', max_keys=None):
+        '''
+        Lazily yield keys of bucket, requesting a page at a time
+        With delimiter, common prefixes are yielded in place of their keys
+        Stop after max keys if given
+        '''
+        keys = bucket.list(prefix=prefix, delimiter=delimiter)
+        if max_keys:
+            keys = itertools.islice(keys, max_keys)
+        return keys
+
+    def list(self, bucket_name=None, prefix='', delimiter='', max_keys=None,
+             stream=False):
         '''
         List buckets and their objects
         If bucket name specified, give only that bucket in list
         Keys can be called with bucket.keys
+        If stream given, bucket.keys is a generator that lists keys lazily
         '''
         log.debug('Bucket name given:%s' % bucket_name)
         if bucket_name:
@@ -46,6 +88,7 @@ class BoyoClient(object):
             try:
                 buckets = [self.boto.get_bucket(bucket_name)]
             except s3_error, e:
+                self.__check_forbidden(e)
                 log.error('Error getting bucket:%s' % str(e))
                 return None
         else:
@@ -54,6 +97,7 @@ class BoyoClient(object):
                 buckets = self.boto.get_all_buckets()
                 log.debug('Found buckets:%s' % buckets)
             except s3_error, e:
+                self.__check_forbidden(e)
                 log.error('Error getting buckets:%s' % str(e))
                 return None
         # Get keys for all buckets
@@ -61,21 +105,54 @@ class BoyoClient(object):
             log.info('Getting keys for all buckets:%s' % str(buckets))
             for b in buckets:
                 log.debug('Getting keys for bucket:%s' % b.name)
-                b.keys = b.get_all_keys()
+                if stream:
+                    b.keys = self.iter_keys(b, prefix=prefix,
+                                            delimiter=delimiter,
+                                            max_keys=max_keys)
+                else:
+                    b.keys = b.get_all_keys(prefix=prefix, delimiter=delimiter,
+                                            max_keys=max_keys)
         return buckets
 
+    def __upload_file(self, bucket, key_name, file_name, part_size=None,
+                      workers=4):
+        # Upload state kept per file, so a failed upload of the same file
+        # resumes with the parts already uploaded
+        stat = os.stat(file_name)
+        upload_id = hashlib.sha1('%s|%s|%s|%s|%s' % (bucket.name, key_name,
+                                                     file_name, stat.st_size,
+                                                     stat.st_mtime)).hexdigest()
+        state_file = os.path.join(CACHE_DIR, 'upload-%s.json' % upload_id)
+        plan = plan_parts(stat.st_size, workers=workers, part_size=part_size)
+        log.info('Uploading %s bytes in %s parts of %s bytes with %s '
+                 'workers' % (stat.st_size, plan['parts'], plan['part_size'],
+                              plan['workers']))
+        uploader = MultipartUploader(self.connect, bucket.name, key_name,
+                                     plan['part_size'], workers=plan['workers'],
+                                     state_file=state_file)
+        with open(file_name, 'rb') as f:
+            # Part size lets get check the multipart etag of the key
+            uploader.upload(iter(lambda: f.read(CHUNK_SIZE), ''),
+                            metadata={'part-size' : str(plan['part_size'])})
+        return bucket.get_key(key_name)
+
     def create(self, bucket_name, key_name=None, file_name=None,
-               string_contents=None):
+               string_contents=None, part_size=None, workers=4,
+               threshold=MULTIPART_THRESHOLD):
         '''
         Attempt to create bucket with name, also key_name if given
         Key can be created without file or string_contents, but key will be
         blank and useless
+        Files larger than threshold are uploaded in parts of at least part
+        size bytes, by workers uploading parts at once
+        If upload of a file fails, running again with same file resumes it
         '''
         log.info('Checking if bucket:%s exists' % bucket_name)
         try:
             bucket = self.boto.get_bucket(bucket_name)
             log.info('Bucket:%s exists' % bucket_name)
         except s3_error, e:
+            self.__check_forbidden(e)
             log.debug('Cannot create bucket:%s' % str(e))
             log.info('Bucket cannot be found, creating bucket:%s' % bucket_name)
             bucket = self.boto.create_bucket(bucket_name)
@@ -95,6 +172,9 @@ class BoyoClient(object):
         if file_name:
             log.info('Loading contents from file:%s' % file_name)
             full_name = os.path.abspath(file_name)
+            if os.path.getsize(full_name) > threshold:
+                return self.__upload_file(bucket, key_name, full_name,
+                                          part_size=part_size, workers=workers)
             with open(full_name, 'r') as f:
                 key.set_contents_from_file(f)
         elif string_contents:
@@ -102,17 +182,99 @@ class BoyoClient(object):
             key.set_contents_from_string(string_contents)
         return key
 
-    def delete(self, bucket_name, key_name=None, force=False):
+    def __delete_each(self, bucket, key_names):
+        # Delete keys one at a time, return number that failed
+        errors = 0
+        for key_name in key_names:
+            try:
+                bucket.delete_key(key_name)
+            except s3_error, e:
+                self.__check_forbidden(e)
+                log.error('Error deleting key:%s, %s' % (key_name, str(e)))
+                errors += 1
+        return errors
+
+    def __delete_batch(self, bucket_name, key_names):
+        bucket = self.__thread_bucket(bucket_name)
+        if not self.multi_delete:
+            return len(key_names), self.__delete_each(bucket, key_names)
+        try:
+            result = bucket.delete_keys(key_names, quiet=True)
+        except s3_error, e:
+            if e.status == 403:
+                raise
+            # Proxy might not support multi object delete, stop trying it
+            log.debug('Multi object delete failed, deleting keys one at a '
+                      'time:%s' % str(e))
+            self.multi_delete = False
+            return len(key_names), self.__delete_each(bucket, key_names)
+        for error in result.errors:
+            log.error('Error deleting key:%s, %s' % (error.key, error.message))
+        return len(key_names), len(result.errors)
+
+    def delete_keys(self, bucket_name, workers=4, progress=None):
+        '''
+        Delete every key in bucket with multi object deletes
+        Keys are listed a page at a time while workers delete batches
+        If proxy does not support multi object delete, workers delete the
+        keys of each batch one at a time
+        Progress is called with number of keys deleted after every batch
+        Return number of keys that could not be deleted
+        '''
+        bucket = self.boto.get_bucket(bucket_name)
+        # Do not list further ahead than workers can keep up with
+        throttle = threading.Semaphore(workers * 2)
+        stopped = threading.Event()
+        def batches():
+            names = []
+            for key in bucket.list():
+                names.append(key.name)
+                if len(names) == DELETE_BATCH_SIZE:
+                    throttle.acquire()
+                    if stopped.is_set():
+                        return
+                    yield names
+                    names = []
+            if names:
+                throttle.acquire()
+                if not stopped.is_set():
+                    yield names
+        deleted = 0
+        failed = 0
+        pool = ThreadPool(max(workers, 1))
+        try:
+            for count, errors in pool.imap_unordered(
+                    lambda names: self.__delete_batch(bucket_name, names),
+                    batches()):
+                throttle.release()
+                deleted += count - errors
+                failed += errors
+                log.info('Deleted %s keys from bucket:%s' % (deleted,
+                                                            bucket_name))
+                if progress:
+                    progress(deleted)
+        finally:
+            # Unblock listing if it is waiting on a batch that failed
+            stopped.set()
+            throttle.release()
+            pool.close()
+            pool.join()
+        return failed
+
+    def delete(self, bucket_name, key_name=None, force=False, workers=4,
+               progress=None):
         '''
         If bucket and key given, delete key
         If only bucket given, delete bucket
-        If force used on deleting bucket, all keys will be removed first
+        If force used on deleting bucket, all keys will be removed first,
+        by workers deleting batches of keys at once
         '''
         log.info('Checking if bucket:%s exists' % bucket_name)
         try:
             bucket = self.boto.get_bucket(bucket_name)
             log.info('Bucket:%s exists' % bucket_name)
-        except s3_error:
+        except s3_error, e:
+            self.__check_forbidden(e)
             log.error('Error finding bucket:%s' % bucket_name)
             return False
         # If key name given, try and delete key
@@ -121,13 +283,14 @@ class BoyoClient(object):
             try:
                 bucket.delete_key(key_name)
             except s3_error, e:
+                self.__check_forbidden(e)
                 log.error('Error deleting key:%s' % str(e))
                 return False
             return True
         # Else start logic for deleting bucket
         log.info("Attempting to delete bucket:%s" % bucket.name)
         log.debug('Gathering keys for bucket:%s' % bucket.name)
-        keys = bucket.get_all_keys()
+        keys = bucket.get_all_keys(max_keys=1)
         # Only delete bucket if no keys present
         can_delete_bucket = False
         if not keys:
@@ -135,13 +298,16 @@ class BoyoClient(object):
             can_delete_bucket = True
         elif force:
             log.debug('Keys exist, but force specified, deleting keys first')
-            for key in keys:
-                log.debug('Deleting key:%s' % key.name)
-                try:
-                    bucket.delete_key(key.name)
-                except s3_error, s:
-                    log.error('Error deleting key:%s' % str(s))
-                    return False
+            try:
+                failed = self.delete_keys(bucket.name, workers=workers,
+                                          progress=progress)
+            except s3_error, s:
+                self.__check_forbidden(s)
+                log.error('Error deleting keys:%s' % str(s))
+                return False
+            if failed:
+                log.error('Could not delete %s keys' % failed)
+                return False
             can_delete_bucket = True
         if can_delete_bucket:
             log.info('Deleting bucket:%s' % bucket.name)
@@ -149,10 +315,76 @@ class BoyoClient(object):
             return True
         return False
 
-    def get(self, bucket_name, key_name=None, file_name=None):
+    def __get_range(self, bucket_name, key_name, file_name, start, end,
+                    chunk_size):
+        # Write one byte range of key in place, file already has full size
+        key = self.__thread_bucket(bucket_name).new_key(key_name)
+        headers = {'Range' : 'bytes=%s-%s' % (start, end)}
+        log.debug('Getting bytes %s-%s of key:%s' % (start, end, key_name))
+        with open(file_name, 'r+b') as f:
+            f.seek(start)
+            for data in iter_key(key, chunk_size=chunk_size, headers=headers):
+                f.write(data)
+        return end - start + 1
+
+    def __is_manifest(self, bucket_name, key_name):
+        # Swift large objects have an etag over their segments, not their data
+        resp = self.boto.make_request('HEAD', bucket_name, key_name)
+        resp.read()
+        return bool(resp.getheader('x-static-large-object') or
+                    resp.getheader('x-object-manifest'))
+
+    def __download(self, key, file_name, workers, chunk_size, range_size,
+                   verify=True):
+        # Return checksum of data written, data is never all held in memory
+        manifest = verify and self.__is_manifest(key.bucket.name, key.name)
+        checksum = ETagHash(key.etag, key.size,
+                            part_size=key.get_metadata('part-size'),
+                            manifest=manifest)
+        if file_name == '-':
+            for data in iter_key(key, chunk_size=chunk_size):
+                sys.stdout.write(data)
+                checksum.update(data)
+            sys.stdout.flush()
+            return checksum
+        if workers <= 1 or key.size <= range_size:
+            with open(file_name, 'wb') as f:
+                for data in iter_key(key, chunk_size=chunk_size):
+                    f.write(data)
+                    checksum.update(data)
+            return checksum
+        # Ranges finish out of order, so file is read back for checksum
+        with open(file_name, 'wb') as f:
+            f.truncate(key.size)
+        ranges = plan_ranges(key.size, range_size=range_size)
+        log.info('Getting key:%s in %s ranges with %s workers' % (key.name,
+                                                                  len(ranges),
+                                                                  workers))
+        pool = ThreadPool(min(workers, len(ranges)))
+        try:
+            for _ in pool.imap_unordered(
+                    lambda r: self.__get_range(key.bucket.name, key.name,
+                                               file_name, r[0], r[1],
+                                               chunk_size),
+                    ranges):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+        with open(file_name, 'rb') as f:
+            for data in iter(lambda: f.read(chunk_size), ''):
+                checksum.update(data)
+        return checksum
+
+    def get(self, bucket_name, key_name=None, file_name=None, workers=1,
+            verify=True, chunk_size=CHUNK_SIZE, range_size=RANGE_SIZE):
         '''
-        If key name given, return key contents. If file name given, write
-        to that file
+        If key name given, return key contents. If file name given, stream
+        contents to that file, or to stdout if file name is -
+        Keys larger than range size are fetched by workers in parallel
+        ranged gets, straight into place in the file
+        If verify, file contents are checked against the key etag, on a
+        mismatch the file is kept and None returned
         If only bucket name given, return that bucket
         '''
         log.info('Checking bucket:%s exists' % bucket_name)
@@ -160,6 +392,7 @@ class BoyoClient(object):
             bucket = self.boto.get_bucket(bucket_name)
             log.info('Bucket:%s exists' % bucket.name)
         except s3_error, s:
+            self.__check_forbidden(s)
             log.error('Cannot find bucket:%s' % str(s))
             return None
         # If no key name, just return bucket
@@ -170,16 +403,32 @@ class BoyoClient(object):
                                                               bucket.name))
         try:
             key = bucket.get_key(key_name)
-            log.info('Key:%s found for bucket:%s' % (key.name, bucket.name))
         except s3_error, s:
+            self.__check_forbidden(s)
             log.error('Cannot find key:%s' % str(s))
             return None
+        if not key:
+            log.error('Key:%s not found in bucket:%s' % (key_name, bucket.name))
+            return None
+        log.info('Key:%s found for bucket:%s' % (key.name, bucket.name))
         if file_name:
-            full_name = os.path.abspath(file_name)
+            full_name = file_name
+            if file_name != '-':
+                full_name = os.path.abspath(file_name)
             log.info('Writing contents of key:%s to file:%s' % (key.name,
                                                                 full_name))
-            with open(full_name, 'w+') as f:
-                f.write(key.get_contents_as_string())
+            try:
+                checksum = self.__download(key, full_name, workers,
+                                           chunk_size, range_size,
+                                           verify=verify)
+            except s3_error, s:
+                self.__check_forbidden(s)
+                log.error('Error getting key:%s' % str(s))
+                return None
+            if verify and checksum.verify() is False:
+                log.error('Contents of key:%s written to:%s do not match etag' %
+                          (key.name, full_name))
+                return None
             return full_name
         log.info('Returning contents as string')
         return key.get_contents_as_string()
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 import argparse
+import json
 import os
+import sys
 from prettytable import PrettyTable
 
+from openderp.auth import invalidate_token, unauthorized
 from boyo.client import BoyoClient
 
 def parse_args():
@@ -16,22 +19,41 @@ def parse_args():
 
     command_list = subparsers.add_parser('list', help='List buckets or keys')
     command_list.add_argument('bucket', nargs='?', help='Bucket name')
+    command_list.add_argument('--prefix', default='', help='Only keys with prefix')
+    command_list.add_argument('--delimiter', default='',
+                              help='Group keys sharing a prefix up to delimiter')
+    command_list.add_argument('--max-keys', type=int,
+                              help='Max keys to list per bucket')
+    command_list.add_argument('--format', choices=['table', 'plain', 'json'],
+                              default='table',
+                              help='Output format, plain and json print '
+                                   'keys as they are listed')
 
     command_create = subparsers.add_parser('create', help='Create a bucket or key')
     command_create.add_argument('bucket', help='Bucket name')
     command_create.add_argument('key', nargs='?', help='Key name')
     command_create.add_argument('--file', help='File to upload as key')
     command_create.add_argument('--string', help='String to upload as key')
+    command_create.add_argument('--part-size', type=int,
+                                help='Size of parts in MB for large files')
+    command_create.add_argument('--workers', type=int, default=4,
+                                help='Number of parts of a large file to upload at once')
 
     command_delete = subparsers.add_parser('delete', help='Delete a bucket or key')
     command_delete.add_argument('bucket', help='Bucket name')
     command_delete.add_argument('key', nargs='?', help='Key name')
     command_delete.add_argument('--force', '-f', action='store_true', help='Force')
+    command_delete.add_argument('--workers', type=int, default=4,
+                                help='Number of batches of keys to delete at once with force')
 
     command_get = subparsers.add_parser('get', help='Get key')
     command_get.add_argument('bucket', help='Bucket name')
     command_get.add_argument('key', nargs='?', help='Key name')
-    command_get.add_argument('--file', help='File to save to')
+    command_get.add_argument('--file', help='File to save to, - for stdout')
+    command_get.add_argument('--workers', type=int, default=1,
+                             help='Number of ranges of a large key to get at once')
+    command_get.add_argument('--no-verify', action='store_true',
+                             help='Do not check file against key etag')
 
     return p.parse_args()
 
@@ -46,34 +68,58 @@ def get_env(args):
         args.auth_url = os.getenv('OS_AUTH_URL')
     return args
 
-def main():
-    args = get_env(parse_args())
+def show_deleted(count):
+    sys.stderr.write('Deleted %s keys\r' % count)
+    sys.stderr.flush()
+
+def run(args):
     conn = BoyoClient(args.username, args.password,
                       args.tenant_name, args.auth_url)
 
     if args.command == 'list':
-        buckets = conn.list(bucket_name=args.bucket,)
+        buckets = conn.list(bucket_name=args.bucket,
+                            prefix=args.prefix,
+                            delimiter=args.delimiter,
+                            max_keys=args.max_keys,
+                            stream=args.format != 'table',)
         if not buckets:
             print 'Result not found'
             return
         for bucket in buckets:
-            print 'Bucket:', bucket.name
-            table = PrettyTable(['name', 'size'])
+            if args.format == 'table':
+                print 'Bucket:', bucket.name
+                table = PrettyTable(['name', 'size'])
+                for key in bucket.keys:
+                    table.add_row([key.name, getattr(key, 'size', '')])
+                print table
+                continue
             for key in bucket.keys:
-                table.add_row([key.name, key.size])
-            print table
+                # Common prefixes from delimiter have no size
+                size = getattr(key, 'size', None)
+                if args.format == 'json':
+                    print json.dumps({'bucket' : bucket.name,
+                                      'name' : key.name,
+                                      'size' : size})
+                else:
+                    print '%s\t%s\t%s' % (bucket.name, key.name,
+                                          '' if size is None else size)
+                sys.stdout.flush()
 
     if args.command == 'create':
         obj = conn.create(args.bucket,
                           key_name=args.key,
                           file_name=args.file,
-                          string_contents=args.string,)
+                          string_contents=args.string,
+                          part_size=(args.part_size or 0) * 1024 * 1024,
+                          workers=args.workers,)
         print obj.name
 
     if args.command == 'delete':
         result = conn.delete(args.bucket,
                              key_name=args.key,
-                             force=args.force,)
+                             force=args.force,
+                             workers=args.workers,
+                             progress=show_deleted,)
         if result:
             print 'Deleted'
         else:
@@ -82,6 +128,24 @@ def main():
     if args.command == 'get':
         result = conn.get(args.bucket,
                           key_name=args.key,
-                          file_name=args.file,)
-        if result:
+                          file_name=args.file,
+                          workers=args.workers,
+                          verify=not args.no_verify,)
+        # Contents already written to stdout
+        if result and args.file != '-':
             print result
+        elif not result and args.file:
+            sys.exit('Could not get key, or contents do not match etag')
+
+def main():
+    args = get_env(parse_args())
+    try:
+        run(args)
+    except Exception, e:
+        if not unauthorized(e):
+            raise
+        # Cached token revoked before it expired, run once more with a new one
+        sys.stderr.write('Token refused, authenticating again\n')
+        invalidate_token(args.auth_url, args.username, args.tenant_name,
+                         args.password)
+        run(args)
@@ -0,0 +1,112 @@
+import hashlib
+import logging
+import math
+import re
+
+log = logging.getLogger(__name__)
+
+# Bytes read from a response at a time when streaming a key
+CHUNK_SIZE = 1024 * 1024
+# Size of each ranged get when downloading with more than one worker
+RANGE_SIZE = 64 * 1024 * 1024
+# Smallest part s3 allows in a multipart upload, other than the last
+MIN_PART_SIZE = 5 * 1024 * 1024
+# Etags that can be an md5 of the data, or of its parts
+MD5_ETAG = re.compile('^[0-9a-f]{32}(-[0-9]+)?$')
+
+def plan_ranges(size, range_size=RANGE_SIZE):
+    '''Split size bytes into list of inclusive (start, end) byte ranges'''
+    return [(start, min(start + range_size, size) - 1)
+            for start in range(0, size, range_size)]
+
+def iter_key(key, chunk_size=CHUNK_SIZE, headers=None):
+    '''
+    Yield contents of key chunk size bytes at a time
+    Headers are sent with the get, use a Range header to read part of key
+    '''
+    key.open_read(headers=headers)
+    try:
+        while True:
+            data = key.read(chunk_size)
+            if not data:
+                return
+            yield data
+    finally:
+        key.close()
+
+class ETagHash(object):
+    def __init__(self, etag, size, part_size=None, manifest=False):
+        '''
+        Checksum data as it is read and compare it with etag of key
+        Plain etags are md5 of the data, multipart etags are md5 of the
+        md5 of each part with a -parts suffix
+        Part size of a multipart key is taken as given, otherwise guessed as
+        the smallest whole MB size allowed by s3 that gives the same number
+        of parts
+        Manifest is set for swift large objects, their etag is over their
+        segments, not their data
+        '''
+        self.etag = (etag or '').strip('"')
+        self.manifest = manifest
+        self.md5 = hashlib.md5()
+        self.parts = None
+        self.part_size = None
+        self.guessed = False
+        if '-' in self.etag:
+            self.parts = int(self.etag.split('-')[1])
+            if not part_size:
+                self.guessed = True
+                mb = 1024 * 1024
+                part_size = int(math.ceil(size * 1.0 / self.parts / mb)) * mb
+                part_size = max(part_size, MIN_PART_SIZE)
+            self.part_size = int(part_size)
+            self.part_md5s = []
+            self.part_md5 = hashlib.md5()
+            self.part_read = 0
+
+    def update(self, data):
+        if not self.parts:
+            self.md5.update(data)
+            return
+        data = memoryview(data)
+        while len(data):
+            length = min(len(data), self.part_size - self.part_read)
+            self.part_md5.update(data[:length])
+            self.part_read += length
+            data = data[length:]
+            if self.part_read == self.part_size:
+                self.__next_part()
+
+    def __next_part(self):
+        self.part_md5s.append(self.part_md5.digest())
+        self.part_md5 = hashlib.md5()
+        self.part_read = 0
+
+    def hexdigest(self):
+        '''Etag of the data read so far'''
+        if not self.parts:
+            return self.md5.hexdigest()
+        digests = list(self.part_md5s)
+        if self.part_read:
+            digests.append(self.part_md5.digest())
+        return '%s-%s' % (hashlib.md5(''.join(digests)).hexdigest(),
+                          len(digests))
+
+    def verify(self):
+        '''
+        Return True if data read matches etag, False if not
+        Return None if etag cannot be checked, for a manifest, an etag that
+        is not an md5, or a multipart etag with a guessed part size
+        '''
+        digest = self.hexdigest()
+        if digest == self.etag:
+            return True
+        if self.manifest or not MD5_ETAG.match(self.etag):
+            log.warn('Cannot verify etag:%s, not an md5 of the data' % self.etag)
+            return None
+        if self.guessed:
+            log.warn('Cannot verify multipart etag:%s, guessed part size:%s '
+                     'gives:%s' % (self.etag, self.part_size, digest))
+            return None
+        log.error('Etag:%s does not match checksum:%s' % (self.etag, digest))
+        return False
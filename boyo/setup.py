@@ -10,6 +10,7 @@ setuptools.setup(
     install_requires=[
         'python-keystoneclient >= 0.9.0',
         'boto >= 2.31.1',
+        'openderp >= 0.1',
     ],
     entry_points={
         'console_scripts' : [
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+'''
+Compare dict per tenant aggregation with TenantCounters on fake servers
+and volumes, no OpenStack needed
+'''
+from cloud_usage.counters import TenantCounters
+
+import argparse
+from copy import deepcopy
+import random
+import timeit
+
+NOVA_ARGS = ['ram', 'disk', 'vcpus', 'ephemeral', 'swap', 'instances']
+CINDER_ARGS = ['gigabytes', 'volumes']
+
+class FakeServer(object):
+    __slots__ = ('id', 'tenant_id', 'flavor')
+
+    def __init__(self, server_id, tenant_id, flavor_id):
+        self.id = server_id
+        self.tenant_id = tenant_id
+        self.flavor = {'id' : flavor_id}
+
+class FakeVolume(object):
+    __slots__ = ('id', 'tenant_id', 'size')
+
+    def __init__(self, volume_id, tenant_id, size):
+        self.id = volume_id
+        self.tenant_id = tenant_id
+        self.size = size
+
+def make_data(servers, volumes, tenants, flavors):
+    r = random.Random(0)
+    tenant_ids = ['tenant-%s' % i for i in range(tenants)]
+    flavor_dicts = dict()
+    flavor_values = dict()
+    for i in range(flavors):
+        values = (r.choice([512, 2048, 8192]), r.choice([10, 20, 80]),
+                  r.choice([1, 2, 4]), 0, r.choice([0, 512]))
+        flavor_dicts[str(i)] = dict(zip(NOVA_ARGS, values))
+        flavor_values[str(i)] = values + (1,)
+    server_list = [FakeServer(str(i), r.choice(tenant_ids), str(r.randrange(flavors)))
+                   for i in range(servers)]
+    volume_list = [FakeVolume(str(i), r.choice(tenant_ids), r.randint(1, 500))
+                   for i in range(volumes)]
+    return server_list, volume_list, flavor_dicts, flavor_values
+
+def nova_dicts(servers, flavors):
+    # Aggregation as nova_usage did it before TenantCounters
+    nova_default = dict((i, 0) for i in NOVA_ARGS)
+    nova_dict = {'total' : deepcopy(nova_default)}
+    for server in servers:
+        tenant_id = server.tenant_id
+        flav = flavors[server.flavor['id']]
+        nova_dict.setdefault(tenant_id, deepcopy(nova_default))
+        for key, value in flav.iteritems():
+            nova_dict[tenant_id][key] += value
+            nova_dict['total'][key] += value
+        nova_dict[tenant_id]['instances'] += 1
+        nova_dict['total']['instances'] += 1
+    return nova_dict
+
+def nova_counters(servers, flavors):
+    counters = TenantCounters(NOVA_ARGS)
+    for server in servers:
+        flavor_id = server.flavor['id']
+        counters.count(server.tenant_id, flavor_id, flavors[flavor_id])
+    return counters.to_dict()
+
+def cinder_dicts(volumes):
+    # Aggregation as cinder_usage did it before TenantCounters
+    cinder_default = dict((i, 0) for i in CINDER_ARGS)
+    cinder_dict = {'total' : deepcopy(cinder_default)}
+    for volume in volumes:
+        tenant_id = volume.tenant_id
+        cinder_dict.setdefault(tenant_id, deepcopy(cinder_default))
+        cinder_dict[tenant_id]['gigabytes'] += volume.size
+        cinder_dict[tenant_id]['volumes'] += 1
+        cinder_dict['total']['gigabytes'] += volume.size
+        cinder_dict['total']['volumes'] += 1
+    return cinder_dict
+
+def cinder_counters(volumes):
+    counters = TenantCounters(CINDER_ARGS)
+    for volume in volumes:
+        counters.add(volume.tenant_id, (volume.size, 1))
+    return counters.to_dict()
+
+def best_time(function, repeat):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Benchmark usage aggregation')
+    p.add_argument('--servers', type=int, default=100000, help='Fake servers')
+    p.add_argument('--volumes', type=int, default=100000, help='Fake volumes')
+    p.add_argument('--tenants', type=int, default=1000, help='Fake tenants')
+    p.add_argument('--flavors', type=int, default=20, help='Fake flavors')
+    p.add_argument('--repeat', type=int, default=5,
+                   help='Runs of each, best one is shown')
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    servers, volumes, flavor_dicts, flavor_values = make_data(args.servers,
+                                                              args.volumes,
+                                                              args.tenants,
+                                                              args.flavors)
+    if nova_dicts(servers, flavor_dicts) != nova_counters(servers, flavor_values) or \
+        cinder_dicts(volumes) != cinder_counters(volumes):
+        raise SystemExit('Aggregations do not match')
+    runs = [
+        ('nova', lambda: nova_dicts(servers, flavor_dicts),
+         lambda: nova_counters(servers, flavor_values)),
+        ('cinder', lambda: cinder_dicts(volumes),
+         lambda: cinder_counters(volumes)),
+    ]
+    print '%-8s %12s %12s %8s' % ('module', 'dicts (s)', 'counters (s)', 'speedup')
+    for name, old, new in runs:
+        old_time = best_time(old, args.repeat)
+        new_time = best_time(new, args.repeat)
+        print '%-8s %12.4f %12.4f %7.1fx' % (name, old_time, new_time,
+                                             old_time / new_time)
+
+if __name__ == '__main__':
+    main()
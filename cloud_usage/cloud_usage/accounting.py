@@ -0,0 +1,142 @@
+from keystoneclient.openstack.common.apiclient import exceptions as keystone_exceptions
+from keystoneclient.v2_0 import client as key_v2
+
+from openderp.auth import CACHE_DIR, STALE_DURATION, cache_key, read_cache, write_cache
+
+import calendar
+import logging
+import os
+import random
+import string
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+def accounting_file(auth_url, username, tenant_name, cache_dir=CACHE_DIR):
+    '''Default file to keep swift accounting identity in'''
+    return os.path.join(cache_dir, 'swift-accounting-%s.json' %
+                        cache_key(auth_url, username, tenant_name))
+
+class SwiftAccounting(object):
+    def __init__(self, keystone, auth_url, file_name):
+        '''
+        Keystone user kept between runs to read swift accounts of every tenant
+        User, tenants it was added to, and a token and storage url per tenant
+        are kept in file, so keystone is only written to for new tenants and
+        only asked for tokens that are about to expire
+        File holds the user password, it is only readable by current user
+        '''
+        self.keystone = keystone
+        self.auth_url = auth_url
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.member = None
+        self.state = read_cache(file_name) or dict()
+        self.state.setdefault('tenants', dict())
+
+    def __random_string(self, length=20):
+        chars = string.ascii_lowercase + string.digits
+        return ''.join(random.SystemRandom().choice(chars) for _ in range(length))
+
+    def __member_role(self):
+        if not self.member:
+            for role in self.keystone.roles.list():
+                if role.name in ['_member_', 'member']:
+                    self.member = role
+                    break
+        return self.member
+
+    def __user_exists(self):
+        try:
+            self.keystone.users.get(self.state['user_id'])
+            return True
+        except keystone_exceptions.NotFound:
+            return False
+
+    def ensure_user(self):
+        '''Create accounting user, unless user from last run still exists'''
+        if self.state.get('user_id') and self.__user_exists():
+            return
+        username = 'cloud-usage-%s' % self.__random_string(length=10)
+        password = self.__random_string()
+        log.info('Creating swift accounting user:%s' % username)
+        user = self.keystone.users.create(username, password, None)
+        self.state = {'user_id' : user.id,
+                      'username' : username,
+                      'password' : password,
+                      'tenants' : dict()}
+        self.save()
+
+    def prune(self, tenant_ids):
+        '''Forget tenants no longer in keystone'''
+        tenant_ids = set(tenant_ids)
+        with self.lock:
+            for tenant_id in self.state['tenants'].keys():
+                if tenant_id not in tenant_ids:
+                    log.debug('Forgetting removed tenant:%s' % tenant_id)
+                    del self.state['tenants'][tenant_id]
+
+    def __grant(self, tenant):
+        log.debug('Adding accounting user to tenant:%s' % tenant.id)
+        try:
+            tenant.add_user(self.state['user_id'], self.__member_role().id)
+        except keystone_exceptions.Conflict:
+            log.debug('Accounting user already member of tenant:%s' % tenant.id)
+
+    def __authenticate(self, tenant):
+        keystone = key_v2.Client(username=self.state['username'],
+                                 password=self.state['password'],
+                                 tenant_id=tenant.id,
+                                 auth_url=self.auth_url)
+        auth_ref = keystone.auth_ref
+        return {'url' : auth_ref.service_catalog.url_for(service_type='object-store'),
+                'token' : auth_ref.auth_token,
+                'expires' : calendar.timegm(auth_ref.expires.utctimetuple())}
+
+    def account(self, tenant):
+        '''
+        Return (storage url, token) for swift account of tenant
+        User is added to tenant only the first time, token is reused until
+        it is about to expire
+        If keystone refuses a new token for a cached tenant, user is added
+        to tenant again and token requested once more
+        '''
+        with self.lock:
+            cached = self.state['tenants'].get(tenant.id)
+        if cached and cached.get('expires', 0) > time.time() + STALE_DURATION:
+            return cached['url'], cached['token']
+        if not cached:
+            self.__grant(tenant)
+        log.debug('Getting swift token for tenant:%s' % tenant.id)
+        try:
+            account = self.__authenticate(tenant)
+        except keystone_exceptions.Unauthorized:
+            if not cached:
+                raise
+            # User might have been removed from tenant since it was cached
+            log.debug('Token refused for tenant:%s, adding user again' % tenant.id)
+            self.invalidate(tenant.id)
+            self.__grant(tenant)
+            account = self.__authenticate(tenant)
+        with self.lock:
+            self.state['tenants'][tenant.id] = account
+        return account['url'], account['token']
+
+    def invalidate(self, tenant_id):
+        '''Drop token and membership of tenant, both are made again when needed'''
+        with self.lock:
+            self.state['tenants'].pop(tenant_id, None)
+
+    def save(self):
+        with self.lock:
+            write_cache(self.file_name, self.state)
+
+    def delete(self):
+        '''Delete accounting user from keystone, along with the file'''
+        if self.state.get('user_id') and self.__user_exists():
+            log.info('Deleting swift accounting user:%s' % self.state['username'])
+            self.keystone.users.delete(self.state['user_id'])
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+        self.state = {'tenants' : dict()}
@@ -1,6 +1,12 @@
 #!/usr/bin/env python
 
+from openderp.auth import invalidate_token, unauthorized
+from openderp.pagination import PAGE_SIZE
+
+from cloud_usage.accounting import SwiftAccounting, accounting_file
 from cloud_usage.client import CloudUsage
+from cloud_usage.exporter import DEFAULT_PORT, UsageExporter
+from cloud_usage.snapshot import UsageSnapshot, snapshot_file, usage_diff
 
 import argparse
 import logging
@@ -17,6 +23,10 @@ handle.setLevel(logging.ERROR)
 form = logging.Formatter(log_format)
 handle.setFormatter(form)
 log.addHandler(handle)
+# Shared code logs under its own package
+shared_log = logging.getLogger('openderp')
+shared_log.setLevel(logging.DEBUG)
+shared_log.addHandler(handle)
 
 def parse_args():
     p = argparse.ArgumentParser(description='Create & Setup OpenStack Accounts')
@@ -24,6 +34,35 @@ def parse_args():
     p.add_argument('--password', help='OpenStack Auth password')
     p.add_argument('--tenant_name', help='OpenStack Auth tenant name')
     p.add_argument('--auth_url', help='OpenStack Auth keystone url')
+    p.add_argument('--workers', type=int, default=1,
+                   help='Number of services to collect concurrently')
+    p.add_argument('--swift-workers', type=int, default=1,
+                   help='Number of tenants to query swift for concurrently')
+    p.add_argument('--page-size', type=int, default=PAGE_SIZE,
+                   help='Number of volumes or servers to list per request')
+    p.add_argument('--tenant-workers', type=int, default=1,
+                   help='Number of tenants to list volumes and servers for '
+                        'concurrently')
+    p.add_argument('--swift-accounting', action='store_true',
+                   help='Read swift with a user kept between runs, instead of '
+                        'a temporary user added to every tenant')
+    p.add_argument('--delete-swift-accounting', action='store_true',
+                   help='Delete user kept for swift accounting and exit')
+    p.add_argument('--snapshot', action='store_true',
+                   help='Only list resources changed since last snapshot run')
+    p.add_argument('--snapshot-file',
+                   help='File to keep snapshot in, implies --snapshot')
+    p.add_argument('--full', action='store_true',
+                   help='List every resource and replace snapshot')
+    p.add_argument('--diff', action='store_true',
+                   help='Only show per tenant changes since last snapshot run')
+    p.add_argument('--daemon', action='store_true',
+                   help='Keep refreshing usage and serve it over http')
+    p.add_argument('--listen', default='127.0.0.1:%s' % DEFAULT_PORT,
+                   help='Address to serve usage on in daemon mode')
+    p.add_argument('--interval', action='append', default=[],
+                   metavar='SERVICE=SECONDS',
+                   help='Seconds between refreshes of a service in daemon mode')
     return p.parse_args()
 
 def get_env_args(args):
@@ -42,24 +81,89 @@ def get_env_args(args):
             sys.exit("Don't have:%s, exiting" % item)
     return args
 
-def main():
-    args = get_env_args(parse_args())
-    c = CloudUsage(args.username, args.password,
-                   args.tenant_name, args.auth_url)
+def parse_intervals(intervals):
+    result = dict()
+    for interval in intervals:
+        try:
+            service, seconds = interval.split('=')
+            result[service] = int(seconds)
+        except ValueError:
+            sys.exit('Invalid interval:%s, use SERVICE=SECONDS' % interval)
+    return result
+
+def run_daemon(c, args, snapshot, accounting):
+    host, port = args.listen.rsplit(':', 1)
+    exporter = UsageExporter(c, intervals=parse_intervals(args.interval),
+                             swift_workers=args.swift_workers,
+                             snapshot=snapshot,
+                             accounting=accounting,
+                             page_size=args.page_size,
+                             tenant_workers=args.tenant_workers)
+    exporter.start()
+    try:
+        exporter.serve(host=host, port=int(port))
+    except KeyboardInterrupt:
+        pass
 
-    data = c.cloud_usage()
-    show_keys = data.keys()
-    for key in show_keys:
+def show_usage(data):
+    for key in data.keys():
         print 'Module --', key
-        raw_columns = data[key]['total'].keys()
+        # Diffs only have the values that changed for each tenant
+        raw_columns = sorted(set(c for value in data[key].values() for c in value))
         columns = ['tenant'] + raw_columns
         table = PrettyTable(columns)
         for tenant, value in data[key].iteritems():
             row = [tenant]
             for c in raw_columns:
-                row.append(value[c])
+                row.append(value.get(c, ''))
             table.add_row(row)
         print table
 
+def run(args):
+    c = CloudUsage(args.username, args.password,
+                   args.tenant_name, args.auth_url)
+
+    accounting = None
+    if args.swift_accounting or args.delete_swift_accounting:
+        accounting = SwiftAccounting(c.keystone, args.auth_url,
+                                     accounting_file(args.auth_url, args.username,
+                                                     args.tenant_name))
+    if args.delete_swift_accounting:
+        accounting.delete()
+        return
+    snapshot = None
+    if args.snapshot or args.snapshot_file or args.diff:
+        snapshot = UsageSnapshot(args.snapshot_file or
+                                 snapshot_file(args.auth_url, args.username,
+                                               args.tenant_name))
+    if args.daemon:
+        run_daemon(c, args, snapshot, accounting)
+        return
+    last_usage = snapshot and snapshot.usage
+    data = c.cloud_usage(workers=args.workers,
+                         swift_workers=args.swift_workers,
+                         snapshot=snapshot,
+                         full=args.full,
+                         accounting=accounting,
+                         page_size=args.page_size,
+                         tenant_workers=args.tenant_workers)
+    if args.diff:
+        show_usage(usage_diff(last_usage, data))
+    else:
+        show_usage(data)
+
+def main():
+    args = get_env_args(parse_args())
+    try:
+        run(args)
+    except Exception, e:
+        if not unauthorized(e):
+            raise
+        # Cached token revoked before it expired, run once more with a new one
+        log.error('Token refused, authenticating again:%s' % str(e))
+        invalidate_token(args.auth_url, args.username, args.tenant_name,
+                         args.password)
+        run(args)
+
 if __name__ == '__main__':
     main()
@@ -1,16 +1,23 @@
-from cinderclient.v1 import client as cinder_v1
-from glanceclient import Client as glance_client
-from keystoneclient.v2_0 import client as key_v2
 from keystoneclient.openstack.common.apiclient import exceptions as keystone_exceptions
-from neutronclient.v2_0 import client as neutron_v2
-from novaclient.v1_1 import client as nova_v1
 import swiftclient
 
+from openderp.auth import STALE_DURATION, CachedAuth, unauthorized
+from openderp.pagination import IMAGE_PAGE_SIZE, PAGE_SIZE, iter_images
+from openderp.pagination import iter_offset_paged, iter_paged
+
+from cloud_usage.counters import TenantCounters
+from cloud_usage.snapshot import apply_changes
+
 from contextlib import contextmanager
 from copy import deepcopy
+from functools import partial
 import logging
+from multiprocessing.pool import ThreadPool
 import random
 import string
+import threading
+import time
+from urlparse import urlparse
 
 log = logging.getLogger(__name__)
 
@@ -18,28 +25,57 @@ CINDER_ARGS = ['gigabytes', 'volumes']
 NOVA_ARGS = ['ram', 'disk', 'vcpus', 'ephemeral', 'swap', 'instances']
 GLANCE_ARGS = ['bytes', 'images']
 SWIFT_ARGS = ['containers', 'bytes']
+NEUTRON_ARGS = ['networks', 'shared_networks']
+
+class TenantIndex(object):
+    def __init__(self, tenants):
+        '''Keystone tenants looked up by id or by name'''
+        self.tenants = list(tenants)
+        self.by_id = dict((t.id, t) for t in self.tenants)
+        self.by_name = dict((t.name, t) for t in self.tenants)
 
 class CloudUsage(object):
     def __init__(self, username, password, tenant_name, auth_url):
         self.os_auth_url = auth_url
+        self.__credentials = (username, password, tenant_name, auth_url)
+        self.__auth_lock = threading.Lock()
+        self.__auth_refused = False
+        self.__connect()
+        # Swift http connections, kept per thread since they are not shareable
+        self.__swift_local = threading.local()
+        # Tenants listed once per report, shared by collectors
+        self.__tenants = None
+        self.__tenants_lock = threading.Lock()
+
+    def __connect(self):
+        # Authenticate once, all clients share the same token
+        self.auth = CachedAuth(*self.__credentials, endpoint_type='adminURL')
+        self.keystone = self.auth.keystone
+        self.cinder = self.auth.cinder_client()
+        self.nova = self.auth.nova_client()
+        self.neutron = self.auth.neutron_client(endpoint_type='adminURL')
+        self.glance = self.auth.glance_client()
 
-        self.cinder = cinder_v1.Client(username, password,
-                                       tenant_name, auth_url)
-        self.nova = nova_v1.Client(username, password,
-                                   tenant_name, auth_url)
-        self.keystone = key_v2.Client(username=username,
-                                      password=password,
-                                      tenant_name=tenant_name,
-                                      auth_url=auth_url,
-                                      endpoint_type='adminURL')
-        self.neutron = neutron_v2.Client(username=username,
-                                         password=password,
-                                         tenant_name=tenant_name,
-                                         auth_url=auth_url,
-                                         endpoint_type='adminURL')
-        token = self.keystone.auth_token
-        image_url = self.keystone.service_catalog.url_for(service_type='image')
-        self.glance = glance_client('1', token=token, endpoint=image_url)
+    def refresh_auth(self):
+        '''
+        Authenticate again and rebuild clients if token is about to expire,
+        or an api refused it
+        Needed by long running processes, glance cannot authenticate itself
+        '''
+        with self.__auth_lock:
+            if self.__auth_refused:
+                log.debug('Token refused, authenticating again')
+                self.__connect()
+                self.__auth_refused = False
+            elif self.keystone.auth_ref.will_expire_soon(stale_duration=STALE_DURATION):
+                log.debug('Token about to expire, authenticating again')
+                self.__connect()
+
+    def invalidate_auth(self):
+        '''Drop token an api refused, next refresh_auth gets a new one'''
+        with self.__auth_lock:
+            self.auth.invalidate()
+            self.__auth_refused = True
 
     def __random_string(self, prefix='', length=10):
         chars = string.ascii_lowercase + string.digits
@@ -52,11 +88,16 @@ class CloudUsage(object):
                 return role
         return None
 
-    def __get_tenant(self, name):
-        for tenant in self.keystone.tenants.list():
-            if tenant.name == name:
-                return tenant
-        return None
+    def tenant_index(self, refresh=False):
+        '''
+        Return TenantIndex of all keystone tenants
+        Tenants are only listed the first time, or when refresh is given
+        '''
+        with self.__tenants_lock:
+            if refresh or self.__tenants is None:
+                log.debug('Loading tenant index')
+                self.__tenants = TenantIndex(self.keystone.tenants.list())
+            return self.__tenants
 
     @contextmanager
     def temp_user(self, username, password):
@@ -66,75 +107,111 @@ class CloudUsage(object):
         finally:
             self.keystone.users.delete(user.id)
 
-    def cinder_usage(self):
+    def __volume_page(self, search_opts, offset=None, limit=None):
+        # Cinder v1 client only passes paging on as search options
+        # Cinder v1 api pages by offset, it has no marker
+        search_opts = dict(search_opts)
+        if offset:
+            search_opts['offset'] = offset
+        if limit:
+            search_opts['limit'] = limit
+        return self.cinder.volumes.list(search_opts=search_opts)
+
+    def __server_page(self, search_opts, marker=None, limit=None):
+        return self.nova.servers.list(search_opts=search_opts, marker=marker,
+                                      limit=limit)
+
+    def __list_all(self, list_page, tenant_option, search_opts=None,
+                   page_size=PAGE_SIZE, workers=1, pages=iter_paged):
+        # Lazily yield resources of all tenants, a page at a time
+        # With workers, each tenant is paged through on its own concurrently,
+        # resources of tenants missing from keystone are not listed then
+        search_opts = dict(search_opts or dict())
+        search_opts['all_tenants'] = 1
+        if workers <= 1:
+            for resource in pages(partial(list_page, search_opts),
+                                  page_size=page_size):
+                yield resource
+            return
+        def tenant_resources(tenant):
+            tenant_opts = dict(search_opts)
+            tenant_opts[tenant_option] = tenant.id
+            return list(pages(partial(list_page, tenant_opts),
+                              page_size=page_size))
+        pool = ThreadPool(workers)
+        try:
+            for resources in pool.imap_unordered(tenant_resources,
+                                                 self.tenant_index().tenants):
+                for resource in resources:
+                    yield resource
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def __volumes(self, page_size=PAGE_SIZE, workers=1):
+        return self.__list_all(self.__volume_page, 'project_id',
+                               page_size=page_size, workers=workers,
+                               pages=iter_offset_paged)
+
+    def __servers(self, search_opts=None, page_size=PAGE_SIZE, workers=1):
+        return self.__list_all(self.__server_page, 'tenant_id',
+                               search_opts=search_opts, page_size=page_size,
+                               workers=workers)
+
+    def cinder_usage(self, page_size=PAGE_SIZE, workers=1):
+        '''
+        Get gigabytes and volumes of every tenant
+        Volumes are listed page size at a time, with workers listing that
+        many tenants at once
+        '''
         log.debug('Loading cinder usage')
-        # Generate default values for cinder args
-        cinder_default = dict()
-        for i in CINDER_ARGS:
-            cinder_default[i] = 0
-        # Cinder dict contains data for each tenant, and total
-        cinder_dict = dict()
-        cinder_dict['total'] = deepcopy(cinder_default)
-        # For each volume, add to values based on size and tenant id
-        for volume in self.cinder.volumes.list(search_opts={'all_tenants' : 1}):
-            log.debug('Adding volume:%s to usage' % volume.id)
-            # Set for tenant
+        # Values of each volume in cinder args order
+        counters = TenantCounters(CINDER_ARGS)
+        for volume in self.__volumes(page_size=page_size, workers=workers):
             tenant_id = getattr(volume, 'os-vol-tenant-attr:tenant_id')
-            cinder_dict.setdefault(tenant_id, deepcopy(cinder_default))
-            cinder_dict[tenant_id]['gigabytes'] += volume.size
-            cinder_dict[tenant_id]['volumes'] += 1
-            # Set for totals
-            cinder_dict['total']['gigabytes'] += volume.size
-            cinder_dict['total']['volumes'] += 1
-        return cinder_dict
-
-    def __flavor_dict(self):
-        # Flavor dict to call ram, vcpus and cores values
+            counters.add(tenant_id, (volume.size, 1))
+        return counters.to_dict()
+
+    def __flavor_values(self):
+        # Flavor id to tuple of values of one server, in nova args order
         log.debug('Loading flavor data')
-        flavor_dict = dict()
+        flavor_values = dict()
         for flav in self.nova.flavors.list():
             log.debug('Adding flavor:%s' % flav.id)
-            flavor_dict[flav.id] = dict()
-            flavor_dict[flav.id]['ram'] = int(flav.ram)
-            flavor_dict[flav.id]['disk'] = int(flav.disk)
-            flavor_dict[flav.id]['vcpus'] = int(flav.vcpus)
-            flavor_dict[flav.id]['ephemeral'] = getattr(flav, 'OS-FLV-EXT-DATA:ephemeral')
             try:
-                flavor_dict[flav.id]['swap'] = int(flav.swap)
+                swap = int(flav.swap)
             except ValueError:
-                flavor_dict[flav.id]['swap'] = 0
-        return flavor_dict
+                swap = 0
+            flavor_values[flav.id] = (int(flav.ram),
+                                      int(flav.disk),
+                                      int(flav.vcpus),
+                                      int(getattr(flav, 'OS-FLV-EXT-DATA:ephemeral')),
+                                      swap,
+                                      1)
+        return flavor_values
 
-    def nova_usage(self):
+    def nova_usage(self, page_size=PAGE_SIZE, workers=1):
+        '''
+        Get flavor resources and instances of every tenant
+        Servers are listed page size at a time, with workers listing that
+        many tenants at once
+        '''
         log.debug('Loading nova data')
         # Make sure you can get flavors first
-        flavors = self.__flavor_dict()
-        # Set nova default dict
-        nova_default = dict()
-        for i in NOVA_ARGS:
-            nova_default[i] = 0
-        # Set up nova usage dict and totals
-        nova_dict = dict()
-        nova_dict['total'] = deepcopy(nova_default)
-        for server in self.nova.servers.list(search_opts={'all_tenants' : 1}):
-            log.debug('Adding server:%s to usage' % server.id)
-            #args = vars(server)
-            tenant_id = server.tenant_id
+        flavors = self.__flavor_values()
+        # Servers of a flavor only bump a count, flavor values are added up
+        # once per tenant and flavor
+        counters = TenantCounters(NOVA_ARGS)
+        for server in self.__servers(page_size=page_size, workers=workers):
+            flavor_id = server.flavor['id']
             try:
-                flav = flavors[server.flavor['id']]
+                flav = flavors[flavor_id]
             except KeyError:
-                log.error('Cannot find flavor:%s for server:%s' % (server.flavor['id'],
+                log.error('Cannot find flavor:%s for server:%s' % (flavor_id,
                                                                    server.id))
                 continue
-            nova_dict.setdefault(tenant_id, deepcopy(nova_default))
-            # For every value in flavors
-            for key, value in flav.iteritems():
-                nova_dict[tenant_id][key] += value
-                nova_dict['total'][key] += value
-            # Also iterate instances
-            nova_dict[tenant_id]['instances'] += 1
-            nova_dict['total']['instances'] += 1
-        return nova_dict
+            counters.count(server.tenant_id, flavor_id, flav)
+        return counters.to_dict()
 
     def keystone_usage(self):
         log.debug('Loading keystone data')
@@ -142,111 +219,295 @@ class CloudUsage(object):
         keystone_dict['total'] = dict()
         try:
             keystone_dict['total']['users'] = len(self.keystone.users.list())
-            keystone_dict['total']['projects'] = len(self.keystone.tenants.list())
+            keystone_dict['total']['projects'] = len(self.tenant_index().tenants)
         except keystone_exceptions.Forbidden:
             log.error('Not authorized to get keystone information')
             keystone_dict['total']['users'] = 'not allowed'
             keystone_dict['total']['projects'] = 'not allowed'
         return keystone_dict
 
-    def glance_usage(self):
+    def glance_usage(self, page_size=IMAGE_PAGE_SIZE):
         log.debug('Loading glance data')
-        # Build default dict
-        image_default = dict()
-        for i in GLANCE_ARGS:
-            image_default[i] = 0
-        # Build image dict and totals
-        image_dict = dict()
-        image_dict['total'] = deepcopy(image_default)
-        # For all private images
-        # Keep list of images seen to double check for overlap
-        images_seen = []
-        for image in self.glance.images.list(is_public=False):
-            log.debug('Adding image:%s to usage' % image.id)
-            tenant_id = image.owner
-            image_dict.setdefault(tenant_id, deepcopy(image_default))
-            image_dict[tenant_id]['bytes'] += image.size
-            image_dict[tenant_id]['images'] += 1
-            image_dict['total']['bytes'] += image.size
-            image_dict['total']['images'] += 1
-            images_seen.append(image.id)
-        # For all public images
-        for image in self.glance.images.list(is_public=True):
-            if image.id in images_seen:
+        counters = TenantCounters(GLANCE_ARGS)
+        # Public and private images in one pass
+        for image in iter_images(self.glance, page_size=page_size):
+            counters.add(image.owner, (image.size or 0, 1))
+        return counters.to_dict()
+
+    def __volume_changes(self, changes_since=None, page_size=PAGE_SIZE,
+                         workers=1):
+        # Cinder v1 cannot filter on changes-since, every volume is listed
+        for volume in self.__volumes(page_size=page_size, workers=workers):
+            tenant_id = getattr(volume, 'os-vol-tenant-attr:tenant_id')
+            yield volume.id, tenant_id, [volume.size, 1]
+
+    def __server_changes(self, changes_since=None, page_size=PAGE_SIZE,
+                         workers=1):
+        flavors = self.__flavor_values()
+        search_opts = dict()
+        if changes_since:
+            # Deleted servers are listed too when asking for changes
+            search_opts['changes-since'] = changes_since
+        for server in self.__servers(search_opts=search_opts,
+                                     page_size=page_size, workers=workers):
+            if server.status == 'DELETED':
+                yield server.id, None, None
+                continue
+            try:
+                flav = flavors[server.flavor['id']]
+            except KeyError:
+                log.error('Cannot find flavor:%s for server:%s' % (server.flavor['id'],
+                                                                   server.id))
+                yield server.id, None, None
                 continue
-            log.debug('Adding image:%s to usage' % image.id)
-            tenant_id = image.owner
-            image_dict.setdefault(tenant_id, deepcopy(image_default))
-            image_dict[tenant_id]['bytes'] += image.size
-            image_dict[tenant_id]['images'] += 1
-            image_dict['total']['bytes'] += image.size
-            image_dict['total']['images'] += 1
-        return image_dict
-
-    def swift_usage(self):
+            yield server.id, server.tenant_id, list(flav)
+
+    def __image_changes(self, changes_since=None, page_size=IMAGE_PAGE_SIZE,
+                        workers=1):
+        # Images are always listed in one pass, workers are not used
+        kwargs = dict()
+        if changes_since:
+            # Deleted images are listed too when asking for changes
+            kwargs['filters'] = {'changes-since' : changes_since}
+        for image in iter_images(self.glance, page_size=page_size, **kwargs):
+            if getattr(image, 'deleted', False) or \
+                image.status in ['deleted', 'pending_delete']:
+                yield image.id, None, None
+                continue
+            yield image.id, image.owner, [image.size or 0, 1]
+
+    def incremental_usage(self, snapshot, service, full=False,
+                          page_size=PAGE_SIZE, workers=1):
+        '''
+        Update usage of cinder, nova or glance stored in snapshot
+        Only resources changed since snapshot was taken are listed, their
+        old values are taken out of stored usage and new values added
+        If full, or service not in snapshot, every resource is listed
+        Cinder cannot list changes, its usage is counted from empty every time
+        Page size and workers are used to list volumes and servers
+        '''
+        changes, args = {'cinder' : (self.__volume_changes, CINDER_ARGS),
+                         'nova' : (self.__server_changes, NOVA_ARGS),
+                         'glance' : (self.__image_changes, GLANCE_ARGS)}[service]
+        start = time.time()
+        changes_since = None
+        # Deleted volumes never show up in a listing, so stored cinder
+        # usage would only grow
+        if not full and service != 'cinder':
+            with snapshot.lock:
+                changes_since = snapshot.changes_since(service)
+        log.debug('Loading %s changes since:%s' % (service, changes_since))
+        # Listing is done without the lock, so other services and saves of
+        # the snapshot do not wait on it
+        resources = list(changes(changes_since, page_size=page_size,
+                                 workers=workers))
+        # Snapshot cannot be saved while it is being changed
+        with snapshot.lock:
+            usage, records = snapshot.service(service, full=not changes_since)
+            try:
+                apply_changes(usage, records, resources, args)
+            except Exception:
+                # Stored usage is partly updated, start over on next run
+                snapshot.services.pop(service, None)
+                raise
+            snapshot.update(service, start, usage, records)
+            # Stored usage keeps changing on later runs, report gets a copy
+            return deepcopy(usage)
+
+    def __swift_http_conn(self, storage_url):
+        # Reuse one connection per swift proxy, path is set per account
+        conns = getattr(self.__swift_local, 'conns', None)
+        if conns is None:
+            conns = self.__swift_local.conns = dict()
+        parsed = urlparse(storage_url)
+        if parsed.netloc not in conns:
+            log.debug('Opening connection to swift proxy:%s' % parsed.netloc)
+            conns[parsed.netloc] = swiftclient.client.http_connection(storage_url)[1]
+        return parsed, conns[parsed.netloc]
+
+    def __swift_accounts(self, account_info, workers):
+        # Run account info for every tenant, add up account headers
+        counters = TenantCounters(SWIFT_ARGS)
+        log.debug('Gathering swift data with %s workers' % workers)
+        pool = ThreadPool(max(workers, 1))
+        try:
+            for tenant_id, info in pool.imap_unordered(account_info,
+                                                       self.tenant_index().tenants):
+                # Add values from information
+                containers = int(info['x-account-container-count'])
+                bytes_used = int(info['x-account-bytes-used'])
+                if containers == 0 and bytes_used == 0:
+                    continue
+                counters.add(tenant_id, (containers, bytes_used))
+        finally:
+            # Make sure no grants are in flight before user is changed
+            pool.terminate()
+            pool.join()
+        return counters.to_dict()
+
+    def __swift_head(self, url, token):
+        return swiftclient.client.head_account(url, token,
+                                               http_conn=self.__swift_http_conn(url))
+
+    def swift_usage(self, workers=1, accounting=None):
+        '''
+        Get container count and bytes used of every tenant swift account
+        If accounting given, use its persistent user, otherwise create a
+        temporary user that is added to every tenant and deleted afterwards
+        '''
         log.debug('Loading swift data')
-        # Build swift detault
-        swift_default = dict()
-        for i in SWIFT_ARGS:
-            swift_default[i] = 0
-        # Build with swift data
-        swift_dict = dict()
-        swift_dict['total'] = deepcopy(swift_default)
+        if accounting:
+            return self.__accounting_swift_usage(accounting, workers)
         # Swift is dumb and doesnt let admins query tenants directly
         # To get around this, create temporary user to delete afterwards
         member = self.__get_member_role()
         username = self.__random_string(prefix='user-')
         password = self.__random_string()
         with self.temp_user(username, password) as user:
-            for tenant in self.keystone.tenants.list():
+            def account_info(tenant):
                 log.debug('Gathering data for tenant:%s' % tenant.id)
                 tenant.add_user(user.id, member.id)
-                swift = swiftclient.client.Connection(auth_version='2',
-                                                      user=username,
-                                                      key=password,
-                                                      tenant_name=tenant.name,
-                                                      authurl=self.os_auth_url)
-                info = swift.head_account()
-                # Add values from information
-                containers = int(info['x-account-container-count'])
-                bytes_used = int(info['x-account-bytes-used'])
-                if containers == 0 and bytes_used == 0:
-                    continue
-                swift_dict.setdefault(tenant.id, deepcopy(swift_default))
-                swift_dict[tenant.id]['containers'] += containers
-                swift_dict[tenant.id]['bytes'] += bytes_used
-                swift_dict['total']['containers'] += containers
-                swift_dict['total']['bytes'] += bytes_used
-        return swift_dict
+                url, token = swiftclient.client.get_auth(self.os_auth_url,
+                                                         username, password,
+                                                         auth_version='2',
+                                                         os_options={'tenant_name' : tenant.name})
+                return tenant.id, self.__swift_head(url, token)
+            return self.__swift_accounts(account_info, workers)
+
+    def __accounting_swift_usage(self, accounting, workers):
+        accounting.ensure_user()
+        accounting.prune(self.tenant_index().by_id)
+        def account_info(tenant):
+            log.debug('Gathering data for tenant:%s' % tenant.id)
+            url, token = accounting.account(tenant)
+            try:
+                return tenant.id, self.__swift_head(url, token)
+            except swiftclient.client.ClientException, e:
+                if e.http_status not in [401, 403]:
+                    raise
+                # Token revoked or user removed from tenant since last run
+                log.debug('Swift denied cached access to tenant:%s' % tenant.id)
+                accounting.invalidate(tenant.id)
+                url, token = accounting.account(tenant)
+                return tenant.id, self.__swift_head(url, token)
+        try:
+            return self.__swift_accounts(account_info, workers)
+        finally:
+            accounting.save()
 
     def neutron_usage(self):
         log.debug('Loading neutron usage')
-        usage = dict()
-        default = {'networks' : 0, 'shared_networks' : 0}
-        usage['total'] = deepcopy(default)
+        counters = TenantCounters(NEUTRON_ARGS)
         try:
             networks = self.neutron.list_networks()['networks']
         except keystone_exceptions.EndpointNotFound:
             log.error('No neutron endpoint found')
+            usage = counters.to_dict()
             usage['total']['Endpoint'] = 'URL not found'
             return usage
+        tenants = self.tenant_index().by_id
         for net in networks:
-            log.debug('Adding network:%s to usage' % net)
-            tenant = self.__get_tenant(net['tenant_id'])
-            usage.setdefault(tenant.id, deepcopy(default))
-            usage[tenant.id]['networks'] += 1
-            usage['total']['networks'] += 1
-            if net['shared']:
-                usage[tenant.id]['shared_networks'] += 1
-                usage['total']['shared_networks'] += 1
-        return usage
+            tenant_id = net['tenant_id']
+            if tenant_id not in tenants:
+                log.error('Cannot find tenant:%s for network:%s' % (tenant_id,
+                                                                   net['id']))
+            counters.add(tenant_id, (1, 1 if net['shared'] else 0))
+        return counters.to_dict()
+
+    def __collect(self, name, function):
+        # Run a single collector, keep failures out of the rest of the report
+        log.debug('Collecting usage for:%s' % name)
+        start = time.time()
+        error = None
+        try:
+            result = function()
+        except Exception, e:
+            log.exception('Error collecting usage for:%s' % name)
+            result = {'total' : {'error' : str(e)}}
+            error = e
+        return name, result, time.time() - start, error
+
+    def __collect_all(self, collectors, workers=1):
+        if workers > 1:
+            log.debug('Collecting usage with %s workers' % workers)
+            pool = ThreadPool(min(workers, len(collectors)))
+            try:
+                return pool.map(lambda c: self.__collect(*c), collectors)
+            finally:
+                pool.close()
+                pool.join()
+        return [self.__collect(name, f) for name, f in collectors]
+
+    def collectors(self, swift_workers=1, snapshot=None, full=False,
+                   accounting=None, page_size=PAGE_SIZE, tenant_workers=1):
+        '''
+        Return list of (service name, function returning usage of service)
+        Swift workers is number of tenants to query swift for at once
+        Volumes and servers are listed page size at a time, tenant workers
+        is number of tenants to list them for at once
+        If snapshot given, cinder, nova and glance usage is updated from
+        changes since last run, unless full
+        If accounting given, swift is read with its persistent user
+        '''
+        collectors = [
+            ('keystone', self.keystone_usage),
+            ('cinder', partial(self.cinder_usage, page_size=page_size,
+                               workers=tenant_workers)),
+            ('nova', partial(self.nova_usage, page_size=page_size,
+                             workers=tenant_workers)),
+            ('glance', self.glance_usage),
+            ('swift', lambda: self.swift_usage(workers=swift_workers,
+                                               accounting=accounting)),
+            ('neutron', self.neutron_usage),
+        ]
+        if snapshot:
+            # Services that can be updated from changes since last run
+            for i, (name, _) in enumerate(collectors):
+                if name in ['cinder', 'nova', 'glance']:
+                    collectors[i] = (name, partial(self.incremental_usage,
+                                                   snapshot, name, full=full,
+                                                   page_size=page_size,
+                                                   workers=tenant_workers))
+        return collectors
 
-    def cloud_usage(self):
+    def cloud_usage(self, workers=1, swift_workers=1, snapshot=None,
+                    full=False, accounting=None, page_size=PAGE_SIZE,
+                    tenant_workers=1):
+        '''
+        Collect usage for every service
+        If workers greater than 1, run collectors concurrently in a thread pool
+        Swift workers is number of tenants to query swift for at once
+        Volumes and servers are listed page size at a time, tenant workers
+        is number of tenants to list them for at once
+        If snapshot given, cinder, nova and glance usage is updated from
+        changes since last run, and report is saved to snapshot, unless full
+        If accounting given, swift is read with its persistent user
+        Wall time of each collector stored under "timing"
+        '''
+        # Tenants may have changed since last report, list again when needed
+        with self.__tenants_lock:
+            self.__tenants = None
+        collectors = self.collectors(swift_workers=swift_workers,
+                                     snapshot=snapshot, full=full,
+                                     accounting=accounting,
+                                     page_size=page_size,
+                                     tenant_workers=tenant_workers)
+        results = self.__collect_all(collectors, workers=workers)
+        refused = [r[0] for r in results if r[3] and unauthorized(r[3])]
+        if refused:
+            # Cached token revoked before it expired, get a new one and
+            # collect refused services once more
+            log.debug('Token refused for:%s, authenticating again' % refused)
+            self.invalidate_auth()
+            self.refresh_auth()
+            retried = self.__collect_all([c for c in collectors if c[0] in refused],
+                                         workers=workers)
+            results = [r for r in results if r[0] not in refused] + retried
         usage = dict()
-        usage['keystone'] = self.keystone_usage()
-        usage['cinder'] = self.cinder_usage()
-        usage['nova'] = self.nova_usage()
-        usage['glance'] = self.glance_usage()
-        usage['swift'] = self.swift_usage()
-        usage['neutron'] = self.neutron_usage()
+        usage['timing'] = {'total' : dict()}
+        for name, result, seconds, _ in results:
+            usage[name] = result
+            usage['timing']['total'][name] = round(seconds, 3)
+        if snapshot:
+            snapshot.save(usage)
         return usage
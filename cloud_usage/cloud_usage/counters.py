@@ -0,0 +1,52 @@
+from collections import defaultdict
+
+class TenantCounters(object):
+    __slots__ = ('fields', 'tenants', 'pairs', 'values')
+
+    def __init__(self, fields):
+        '''
+        Per tenant totals of a fixed list of fields
+        Each tenant keeps one list of ints in field order, added to in place,
+        instead of a dict copied from a default for every resource added
+        '''
+        self.fields = tuple(fields)
+        self.tenants = dict()
+        # Count of (tenant, key) pairs, added up once in to_dict
+        self.pairs = defaultdict(int)
+        self.values = dict()
+
+    def add(self, tenant_id, values):
+        '''Add values, in field order, to tenant'''
+        counts = self.tenants.get(tenant_id)
+        if counts is None:
+            self.tenants[tenant_id] = list(values)
+            return
+        # Counts are changed in place, no new list per resource
+        for i, value in enumerate(values):
+            counts[i] += value
+
+    def count(self, tenant_id, key, values):
+        '''
+        Count one resource of tenant with values shared by every resource
+        with the same key, like servers of one flavor
+        Only a counter is bumped, values are added up once per pair
+        '''
+        self.pairs[(tenant_id, key)] += 1
+        self.values[key] = values
+
+    def __flush_pairs(self):
+        for (tenant_id, key), number in self.pairs.iteritems():
+            self.add(tenant_id, [number * v for v in self.values[key]])
+        self.pairs.clear()
+
+    def to_dict(self):
+        '''Usage dict of tenant to field values, with totals under "total"'''
+        self.__flush_pairs()
+        usage = dict()
+        total = [0] * len(self.fields)
+        for tenant_id, counts in self.tenants.iteritems():
+            usage[tenant_id] = dict(zip(self.fields, counts))
+            for i, count in enumerate(counts):
+                total[i] += count
+        usage['total'] = dict(zip(self.fields, total))
+        return usage
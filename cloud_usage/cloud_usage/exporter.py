@@ -0,0 +1,233 @@
+from openderp.auth import unauthorized
+from openderp.pagination import PAGE_SIZE
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import re
+from SocketServer import ThreadingMixIn
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Seconds between refreshes of each service
+DEFAULT_INTERVALS = {
+    'keystone' : 300,
+    'cinder' : 300,
+    'nova' : 300,
+    'glance' : 600,
+    'swift' : 3600,
+    'neutron' : 600,
+}
+DEFAULT_PORT = 9180
+
+def metric_name(*parts):
+    '''Prometheus metric name from parts, invalid characters become _'''
+    return re.sub('[^a-zA-Z0-9_]', '_', '_'.join(parts))
+
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class UsageExporter(object):
+    def __init__(self, cloud_usage, intervals=None, swift_workers=1,
+                 snapshot=None, accounting=None, page_size=PAGE_SIZE,
+                 tenant_workers=1):
+        '''
+        Keep usage of every service in memory, each service refreshed by its
+        own background thread every interval seconds
+        Usage is served from memory as json or prometheus text, so requests
+        never wait on OpenStack apis
+        If snapshot given, cinder, nova and glance only list changes on
+        refresh, and snapshot is saved after every refresh
+        If accounting given, swift is read with its persistent user instead
+        of a new temporary user every refresh
+        Page size and tenant workers are used to list volumes and servers
+        '''
+        self.cloud_usage = cloud_usage
+        self.intervals = dict(DEFAULT_INTERVALS)
+        self.intervals.update(intervals or dict())
+        self.swift_workers = swift_workers
+        self.snapshot = snapshot
+        self.accounting = accounting
+        self.page_size = page_size
+        self.tenant_workers = tenant_workers
+
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.threads = []
+        # Service name to dict of usage, time, seconds and error
+        self.results = dict()
+        # Rendered responses, dropped whenever a service is refreshed
+        self.rendered = dict()
+        self.generation = 0
+
+    def __refresh(self, name, function):
+        start = time.time()
+        error = None
+        try:
+            self.cloud_usage.refresh_auth()
+            if name == 'keystone':
+                # Other services look tenants up from the index
+                self.cloud_usage.tenant_index(refresh=True)
+            usage = function()
+        except Exception, e:
+            log.exception('Error refreshing usage for:%s' % name)
+            error = str(e)
+            if unauthorized(e):
+                self.cloud_usage.invalidate_auth()
+        with self.lock:
+            result = self.results.setdefault(name, {'usage' : None,
+                                                    'time' : None})
+            result['seconds'] = time.time() - start
+            result['error'] = error
+            # Keep serving last good usage if refresh failed
+            if not error:
+                result['usage'] = usage
+                result['time'] = time.time()
+            self.rendered = dict()
+            self.generation += 1
+        if self.snapshot and not error:
+            self.snapshot.save(self.usage())
+        log.debug('Refreshed usage for:%s in %s seconds' % (name,
+                                                           result['seconds']))
+
+    def __run(self, name, function):
+        while not self.stopped.is_set():
+            self.__refresh(name, function)
+            self.stopped.wait(self.intervals[name])
+
+    def start(self):
+        '''Start a refresh thread for each service'''
+        collectors = self.cloud_usage.collectors(swift_workers=self.swift_workers,
+                                                 snapshot=self.snapshot,
+                                                 accounting=self.accounting,
+                                                 page_size=self.page_size,
+                                                 tenant_workers=self.tenant_workers)
+        # Tenants needed by most services, list them once before starting
+        self.cloud_usage.tenant_index(refresh=True)
+        for name, function in collectors:
+            t = threading.Thread(target=self.__run, args=(name, function))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        self.stopped.set()
+
+    def usage(self):
+        '''
+        Latest usage in the same layout as CloudUsage.cloud_usage
+        Refresh time and time of last good refresh of each service stored
+        under "timing"
+        '''
+        with self.lock:
+            usage = dict()
+            timing = {'total' : dict()}
+            for name, result in self.results.iteritems():
+                if result['usage'] is not None:
+                    usage[name] = result['usage']
+                elif result['error']:
+                    usage[name] = {'total' : {'error' : result['error']}}
+                timing['total'][name] = round(result['seconds'], 3)
+                if result['time']:
+                    timing['total']['%s_updated' % name] = int(result['time'])
+            usage['timing'] = timing
+            return usage
+
+    def prometheus(self):
+        '''Latest usage in prometheus text format'''
+        with self.lock:
+            results = dict(self.results)
+        # Lines of a metric have to be kept together
+        lines = ['# TYPE cloud_usage_refresh_seconds gauge']
+        for name in sorted(results):
+            lines.append('cloud_usage_refresh_seconds{service="%s"} %.3f' %
+                         (name, results[name]['seconds']))
+        lines.append('# TYPE cloud_usage_refresh_success gauge')
+        for name in sorted(results):
+            lines.append('cloud_usage_refresh_success{service="%s"} %s' %
+                         (name, 0 if results[name]['error'] else 1))
+        lines.append('# TYPE cloud_usage_last_refresh_timestamp gauge')
+        for name in sorted(results):
+            if results[name]['time']:
+                lines.append('cloud_usage_last_refresh_timestamp{service="%s"} %.3f' %
+                             (name, results[name]['time']))
+        for name in sorted(results):
+            usage = results[name]['usage'] or dict()
+            metrics = dict()
+            for tenant_id, values in usage.iteritems():
+                for key, value in values.iteritems():
+                    # Errors and not allowed markers are not metrics
+                    if isinstance(value, bool) or \
+                        not isinstance(value, (int, long, float)):
+                        continue
+                    if tenant_id == 'total':
+                        # Own metric, sum over tenants would count it twice
+                        metrics[metric_name('cloud_usage', name, key,
+                                            'total')] = [(None, value)]
+                        continue
+                    metrics.setdefault(metric_name('cloud_usage', name, key),
+                                       []).append((tenant_id, value))
+            for metric in sorted(metrics):
+                lines.append('# TYPE %s gauge' % metric)
+                for tenant_id, value in metrics[metric]:
+                    if tenant_id is None:
+                        lines.append('%s %s' % (metric, value))
+                        continue
+                    lines.append('%s{tenant="%s"} %s' % (metric,
+                                                         label_value(tenant_id),
+                                                         value))
+        return '\n'.join(lines) + '\n'
+
+    def render(self, content_type):
+        '''Response body for content type, rendered once per refresh'''
+        with self.lock:
+            body = self.rendered.get(content_type)
+            generation = self.generation
+        if body is not None:
+            return body
+        if content_type == 'json':
+            body = json.dumps(self.usage())
+        else:
+            body = self.prometheus()
+        with self.lock:
+            # Do not cache if a refresh finished while rendering
+            if generation == self.generation:
+                self.rendered[content_type] = body
+        return body
+
+    def serve(self, host='127.0.0.1', port=DEFAULT_PORT):
+        '''Serve /metrics as prometheus text and / as json until stopped'''
+        server = ThreadingHTTPServer((host, port), UsageHandler)
+        server.exporter = self
+        log.info('Serving usage on %s:%s' % (host, port))
+        try:
+            server.serve_forever()
+        finally:
+            self.stop()
+            server.server_close()
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class UsageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            content_type = 'text/plain; version=0.0.4'
+            body = self.server.exporter.render('prometheus')
+        elif path in ['/', '/usage', '/usage.json']:
+            content_type = 'application/json'
+            body = self.server.exporter.render('json')
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('%s - %s' % (self.address_string(), format % args))
@@ -0,0 +1,131 @@
+from openderp.auth import CACHE_DIR, cache_key, read_cache, write_cache
+
+from datetime import datetime
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+# Bump when layout of snapshot file changes, older snapshots are ignored
+SNAPSHOT_VERSION = 2
+# List resources changed this many seconds before the last run started
+# again, covers clock skew between us and the apis
+CHANGES_SINCE_OVERLAP = 300
+
+def snapshot_file(auth_url, username, tenant_name, cache_dir=CACHE_DIR):
+    '''Default snapshot file for one set of credentials'''
+    return os.path.join(cache_dir, 'usage-%s.json' %
+                        cache_key(auth_url, username, tenant_name))
+
+def apply_changes(usage, records, changes, args):
+    '''
+    Apply changed resources to usage dict of tenant to values of args
+    Records is dict of resource id to [tenant id, values] last counted
+    Changes is iterable of (resource id, tenant id, values), values are a
+    list in the same order as args, or None if resource was deleted
+    Old values of a changed resource are taken out of usage before the new
+    ones are added, so the same change can be applied twice
+    Tenant ids are stored as strings, json would turn a None key into null
+    '''
+    usage.setdefault('total', dict((a, 0) for a in args))
+    for resource_id, tenant_id, values in changes:
+        tenant_id = '%s' % tenant_id
+        old = records.pop(resource_id, None)
+        if old:
+            old_tenant, old_values = old
+            tenant_usage = usage[old_tenant]
+            for arg, value in zip(args, old_values):
+                tenant_usage[arg] -= value
+                usage['total'][arg] -= value
+            # Full scan never lists tenants without resources
+            if not any(tenant_usage.values()):
+                del usage[old_tenant]
+        if values is None:
+            continue
+        tenant_usage = usage.get(tenant_id)
+        if tenant_usage is None:
+            tenant_usage = usage[tenant_id] = dict((a, 0) for a in args)
+        for arg, value in zip(args, values):
+            tenant_usage[arg] += value
+            usage['total'][arg] += value
+        records[resource_id] = [tenant_id, values]
+    return usage
+
+def usage_diff(old, new):
+    '''
+    Return per tenant changes between two usage reports
+    Dict of module to tenant to values that changed, with new minus old
+    '''
+    diff = dict()
+    for module, new_usage in new.iteritems():
+        if module == 'timing':
+            continue
+        old_usage = old.get(module, dict())
+        for tenant_id in set(old_usage) | set(new_usage):
+            old_values = old_usage.get(tenant_id, dict())
+            new_values = new_usage.get(tenant_id, dict())
+            for key in set(old_values) | set(new_values):
+                old_value = old_values.get(key, 0)
+                new_value = new_values.get(key, 0)
+                # Errors and not allowed markers are not counts
+                if not isinstance(old_value, (int, long, float)) or \
+                    not isinstance(new_value, (int, long, float)):
+                    continue
+                if new_value != old_value:
+                    changes = diff.setdefault(module, dict())
+                    changes.setdefault(tenant_id, dict())[key] = new_value - old_value
+    return diff
+
+class UsageSnapshot(object):
+    def __init__(self, file_name):
+        '''
+        Usage from the last run kept on disk, along with every volume, server
+        and image counted, so next run only needs resources that changed
+        '''
+        self.file_name = file_name
+        # Held while a service is updated or snapshot is saved
+        self.lock = threading.RLock()
+        data = read_cache(file_name) or dict()
+        if data.get('version') != SNAPSHOT_VERSION:
+            log.debug('No usable snapshot in:%s' % file_name)
+            data = dict()
+        # Last report, used to show what changed
+        self.usage = data.get('usage', dict())
+        # Service name to dict of time, usage and records
+        self.services = data.get('services', dict())
+
+    def changes_since(self, service):
+        '''
+        Timestamp to list changes of service from, None if no snapshot
+        '''
+        state = self.services.get(service)
+        if not state:
+            return None
+        since = datetime.utcfromtimestamp(state['time'] - CHANGES_SINCE_OVERLAP)
+        return since.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def service(self, service, full=False):
+        '''
+        Return (usage, records) to apply changes to for service
+        If full, or no snapshot of service, start from empty usage
+        '''
+        state = self.services.get(service)
+        if full or not state:
+            return dict(), dict()
+        return state['usage'], state['records']
+
+    def update(self, service, start_time, usage, records):
+        '''Record usage of service, collected from changes since start time'''
+        self.services[service] = {'time' : start_time,
+                                  'usage' : usage,
+                                  'records' : records}
+
+    def save(self, usage):
+        '''Save report and service state to snapshot file'''
+        with self.lock:
+            self.usage = usage
+            log.debug('Saving usage snapshot to:%s' % self.file_name)
+            write_cache(self.file_name, {'version' : SNAPSHOT_VERSION,
+                                         'usage' : usage,
+                                         'services' : self.services})
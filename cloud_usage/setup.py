@@ -8,6 +8,7 @@ setuptools.setup(
     author_email='ty_north@yahoo.com',
     description='OpenStack Cloud Usage Script',
     install_requires=[
+        'openderp >= 0.1',
         'python-cinderclient >= 1.0.9',
         'python-glanceclient >= 0.13.1',
         'python-keystoneclient >= 0.10.1',
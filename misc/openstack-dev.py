@@ -7,8 +7,9 @@ import code
 from novaclient.v1_1 import client as nova_v1
 from novaclient.shell import OpenStackComputeShell as open_shell
 from glanceclient import Client as glance_client
-from keystoneclient.v2_0 import client as key_v2
+from keystoneclient.openstack.common.apiclient import exceptions as keystone_exceptions
 from neutronclient.v2_0 import client as neutron_v2
+from openderp.auth import CachedAuth
 import os
 import swiftclient
 import sys
@@ -44,6 +45,12 @@ def get_env(args):
 def main():
     args = vars(parse_args())
     args = get_env(args)
+    # Token cache shared with the other OpenDerp clients
+    keystone = CachedAuth(args['username'], args['password'],
+                          args['tenant_name'], args['auth_url'],
+                          cacert=args['ca_cert']).keystone
+    token = keystone.auth_token
+    service_catalog = keystone.service_catalog
     extensions = open_shell()._discover_extensions("1.1")
     nova = nova_v1.Client(args['username'],
                           args['password'],
@@ -51,28 +58,34 @@ def main():
                           args['auth_url'],
                           extensions=extensions,
                           cacert=args['ca_cert'])
-    keystone = key_v2.Client(username=args['username'],
-                             password=args['password'],
-                             tenant_name=args['tenant_name'],
-                             auth_url=args['auth_url'],
-                             cacert=args['ca_cert'],)
-    neutron = neutron_v2.Client(username=args['username'],
-                                password=args['password'],
-                                tenant_name=args['tenant_name'],
-                                auth_url=args['auth_url'],
-                                cacert=args['ca_cert'],)
+    nova.client.auth_token = token
+    nova.client.management_url = service_catalog.url_for(service_type='compute')
+    neutron_args = {'username' : args['username'],
+                    'password' : args['password'],
+                    'tenant_name' : args['tenant_name'],
+                    'auth_url' : args['auth_url'],
+                    'cacert' : args['ca_cert']}
+    try:
+        neutron_args.update({'token' : token,
+                             'endpoint_url' : service_catalog.url_for(service_type='network')})
+    except keystone_exceptions.EndpointNotFound:
+        # Let client fail on its own when it is used
+        pass
+    neutron = neutron_v2.Client(**neutron_args)
     cinder = cinder_v1.Client(args['username'],
                               args['password'],
                               args['tenant_name'],
                               args['auth_url'],
                               cacert=args['ca_cert'],)
+    cinder.client.auth_token = token
+    cinder.client.management_url = service_catalog.url_for(service_type='volume')
     swift = swiftclient.client.Connection(auth_version='2',
                                           user=args['username'],
                                           key=args['password'],
                                           tenant_name=args['tenant_name'],
-                                          authurl=args['auth_url'])
-    token = keystone.auth_token
-    service_catalog = keystone.service_catalog
+                                          authurl=args['auth_url'],
+                                          preauthurl=service_catalog.url_for(service_type='object-store'),
+                                          preauthtoken=token)
     catalog = service_catalog.catalog['serviceCatalog']
     glance_ip = None
     for endpoint in catalog:
@@ -0,0 +1,246 @@
+from keystoneclient import access
+from keystoneclient.openstack.common.apiclient import exceptions as keystone_exceptions
+from keystoneclient.v2_0 import client as key_v2
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from urlparse import urlparse
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.openderp')
+# Authenticate again if cached token expires within this many seconds
+STALE_DURATION = 300
+# Trust cached ec2 credentials and s3 endpoint for this many seconds
+EC2_CACHE_TTL = 86400
+
+def cache_key(auth_url, username, tenant_name):
+    '''Key used to name cache files for one set of credentials'''
+    return hashlib.sha1('%s|%s|%s' % (auth_url, username, tenant_name)).hexdigest()
+
+def read_cache(file_name):
+    '''Return json contents of cache file, or None if missing or corrupt'''
+    try:
+        with open(file_name, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def write_cache(file_name, data):
+    '''Atomically write json data to a cache file only readable by user'''
+    cache_dir = os.path.dirname(file_name)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, 0700)
+    fd, temp_name = tempfile.mkstemp(dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(temp_name, file_name)
+    except (IOError, OSError), e:
+        log.error('Cannot write cache file:%s, %s' % (file_name, str(e)))
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+
+def ec2_settings(keystone):
+    '''Get ec2 credentials, creating them if needed, and s3 host and port'''
+    creds = keystone.ec2.list(keystone.user_id)
+    if len(creds) == 0:
+        keystone.ec2.create(keystone.user_id, keystone.tenant_id)
+        creds = keystone.ec2.list(keystone.user_id)
+    cred = creds[-1]
+    s3_url = urlparse(keystone.service_catalog.url_for(service_type='object-store'))
+    host, port = s3_url.netloc.split(':')
+    return {'access' : cred.access, 'secret' : cred.secret,
+            'host' : host, 'port' : int(port)}
+
+class Ec2Cache(object):
+    def __init__(self, username, tenant_name, auth_url, cache_dir=CACHE_DIR,
+                 ttl=EC2_CACHE_TTL):
+        '''
+        Cache ec2 credentials and object store endpoint used for s3 clients
+        Settings older than ttl seconds are ignored
+        '''
+        self.cache_file = os.path.join(cache_dir, 'ec2-%s.json' %
+                                       cache_key(auth_url, username, tenant_name))
+        self.ttl = ttl
+
+    def get(self):
+        settings = read_cache(self.cache_file)
+        if not settings:
+            return None
+        if time.time() - settings.get('timestamp', 0) > self.ttl:
+            log.debug('Cached ec2 credentials expired')
+            return None
+        log.debug('Using cached ec2 credentials from file:%s' % self.cache_file)
+        return settings
+
+    def set(self, settings):
+        settings = dict(settings, timestamp=time.time())
+        log.debug('Caching ec2 credentials in file:%s' % self.cache_file)
+        write_cache(self.cache_file, settings)
+
+    def invalidate(self):
+        log.debug('Removing cached ec2 credentials')
+        try:
+            os.remove(self.cache_file)
+        except OSError:
+            pass
+
+def token_file(auth_url, username, tenant_name, password, cache_dir=CACHE_DIR):
+    '''
+    Cache file of keystone token for one set of credentials
+    Password is part of the key, so a wrong password never finds a token
+    '''
+    key = hashlib.sha1('%s|%s' % (cache_key(auth_url, username, tenant_name),
+                                  password)).hexdigest()
+    return os.path.join(cache_dir, 'token-%s.json' % key)
+
+def invalidate_token(auth_url, username, tenant_name, password,
+                     cache_dir=CACHE_DIR):
+    '''Remove cached token, so next run authenticates again'''
+    file_name = token_file(auth_url, username, tenant_name, password,
+                           cache_dir=cache_dir)
+    log.debug('Removing cached token file:%s' % file_name)
+    try:
+        os.remove(file_name)
+    except OSError:
+        pass
+
+def unauthorized(error):
+    '''True if error is an api refusing the token, from any client'''
+    for attr in ['http_status', 'code', 'status_code', 'status']:
+        if getattr(error, attr, None) == 401:
+            return True
+    return False
+
+class CachedAuth(object):
+    def __init__(self, username, password, tenant_name, auth_url,
+                 endpoint_type='publicURL', cache_dir=CACHE_DIR, cache=True,
+                 cacert=None):
+        '''
+        Authenticate once to keystone, reusing token and service catalog
+        cached on disk from previous runs until it is about to expire
+        Long running callers use refresh to get a new token as it expires
+        '''
+        self.username = username
+        self.password = password
+        self.tenant_name = tenant_name
+        self.auth_url = auth_url
+        self.endpoint_type = endpoint_type
+        self.cacert = cacert
+        self.cache = cache
+        self.cache_dir = cache_dir
+        self.cache_file = token_file(auth_url, username, tenant_name, password,
+                                     cache_dir=cache_dir)
+        self.lock = threading.Lock()
+        auth_ref = None
+        if cache:
+            auth_ref = self.__load_auth_ref()
+        self.__authenticate(auth_ref=auth_ref)
+
+    def __authenticate(self, auth_ref=None):
+        self.keystone = key_v2.Client(username=self.username,
+                                      password=self.password,
+                                      tenant_name=self.tenant_name,
+                                      auth_url=self.auth_url,
+                                      endpoint_type=self.endpoint_type,
+                                      cacert=self.cacert,
+                                      auth_ref=auth_ref)
+        if self.cache and not auth_ref:
+            log.debug('Caching token in file:%s' % self.cache_file)
+            write_cache(self.cache_file, dict(self.keystone.auth_ref))
+
+    def refresh(self):
+        '''
+        Authenticate again if token is about to expire
+        Return True if token changed, clients only given the token, like
+        glance, have to be made again
+        '''
+        with self.lock:
+            if not self.keystone.auth_ref.will_expire_soon(stale_duration=STALE_DURATION):
+                return False
+            log.debug('Token about to expire, authenticating again')
+            self.__authenticate()
+            return True
+
+    def __load_auth_ref(self):
+        auth_ref = read_cache(self.cache_file)
+        if not auth_ref:
+            log.debug('No cached token found')
+            return None
+        try:
+            expiring = access.AccessInfo.factory(**auth_ref).will_expire_soon(
+                stale_duration=STALE_DURATION)
+        except (KeyError, TypeError, ValueError):
+            log.debug('Cached token invalid, ignoring')
+            return None
+        if expiring:
+            log.debug('Cached token expired')
+            return None
+        log.debug('Using cached token from file:%s' % self.cache_file)
+        return auth_ref
+
+    def invalidate(self):
+        '''Remove cached token, called when an api refuses it'''
+        invalidate_token(self.auth_url, self.username, self.tenant_name,
+                         self.password, cache_dir=self.cache_dir)
+
+    @property
+    def token(self):
+        return self.keystone.auth_token
+
+    def url_for(self, service_type, endpoint_type='publicURL'):
+        return self.keystone.service_catalog.url_for(service_type=service_type,
+                                                     endpoint_type=endpoint_type)
+
+    def __preauth(self, client, service_type):
+        # Hand token to client so it does not authenticate on its own
+        # Client will still use password to authenticate if token expires
+        client.client.auth_token = self.token
+        client.client.management_url = self.url_for(service_type)
+        return client
+
+    # Service clients are imported when made, each package only depends
+    # on the clients it uses
+
+    def cinder_client(self):
+        from cinderclient.v1 import client as cinder_v1
+        cinder = cinder_v1.Client(self.username, self.password,
+                                  self.tenant_name, self.auth_url)
+        return self.__preauth(cinder, 'volume')
+
+    def glance_client(self):
+        from glanceclient import Client as glance_client
+        return glance_client('1', token=self.token,
+                             endpoint=self.url_for('image'))
+
+    def neutron_client(self, endpoint_type='publicURL'):
+        from neutronclient.v2_0 import client as neutron_v2
+        try:
+            url = self.url_for('network', endpoint_type=endpoint_type)
+        except keystone_exceptions.EndpointNotFound:
+            # Let client fail on its own when it is used
+            log.debug('No network endpoint in service catalog')
+            return neutron_v2.Client(username=self.username,
+                                     password=self.password,
+                                     tenant_name=self.tenant_name,
+                                     auth_url=self.auth_url,
+                                     endpoint_type=endpoint_type)
+        return neutron_v2.Client(username=self.username,
+                                 password=self.password,
+                                 tenant_name=self.tenant_name,
+                                 auth_url=self.auth_url,
+                                 endpoint_type=endpoint_type,
+                                 token=self.token,
+                                 endpoint_url=url)
+
+    def nova_client(self):
+        from novaclient.v1_1 import client as nova_v1
+        nova = nova_v1.Client(self.username, self.password,
+                              self.tenant_name, self.auth_url)
+        return self.__preauth(nova, 'compute')
@@ -0,0 +1,289 @@
+from boto.s3.multipart import MultiPartUpload
+
+import json
+import logging
+import math
+import os
+import Queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Times to try uploading a single part before giving up
+PART_RETRIES = 5
+# S3 multipart limits
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+
+def buffer_count(workers):
+    '''Number of part buffers an uploader with workers keeps in memory'''
+    return 2 * workers + 1
+
+def plan_parts(size, workers=4, max_memory=None, part_size=None):
+    '''
+    Pick part size and workers for uploading size bytes
+    Parts are the smallest whole MB size of at least part size bytes that
+    fits in the S3 part limits, workers are reduced until part buffers fit
+    in max memory bytes
+    Return dict of part_size, parts, workers and memory
+    Raise ValueError if no plan fits the limits
+    '''
+    mb = 1024 * 1024
+    part_size = max(MIN_PART_SIZE, int(part_size or 0),
+                    int(math.ceil(size * 1.0 / MAX_PARTS)))
+    part_size = int(math.ceil(part_size * 1.0 / mb)) * mb
+    if part_size > MAX_PART_SIZE:
+        raise ValueError('Size:%s too large for multipart upload' % size)
+    parts = max(int(math.ceil(size * 1.0 / part_size)), 1)
+    # No point in more workers than parts
+    workers = max(min(int(workers), parts), 1)
+    if max_memory:
+        while workers > 1 and buffer_count(workers) * part_size > max_memory:
+            workers -= 1
+        if buffer_count(workers) * part_size > max_memory:
+            raise ValueError('Max memory:%s too small, need at least:%s' %
+                             (max_memory, buffer_count(1) * part_size))
+    return {'part_size' : part_size,
+            'parts' : parts,
+            'workers' : workers,
+            'memory' : buffer_count(workers) * part_size}
+
+class PartFile(object):
+    def __init__(self, buff, size):
+        '''
+        Read only file over the first size bytes of a part buffer
+        Lets boto read a part in place instead of copying it to a string
+        '''
+        self.view = memoryview(buff)[:size]
+        self.size = size
+        self.position = 0
+
+    def read(self, size=-1):
+        start = self.position
+        if size is None or size < 0:
+            end = self.size
+        else:
+            end = min(start + size, self.size)
+        self.position = end
+        return self.view[start:end].tobytes()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = min(max(offset, 0), self.size)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.view = None
+
+class MultipartUploader(object):
+    def __init__(self, connection_factory, bucket_name, key_name, part_size,
+                 workers=4, state_file=None, retries=PART_RETRIES):
+        '''
+        Upload a stream of data to a key using multipart upload
+        Stream is split into parts on a bounded queue, worker threads each
+        with their own s3 connection upload parts concurrently
+        Parts are written in place into a fixed pool of part buffers, so
+        memory used never goes above part size * (2 * workers + 1)
+        Uploaded parts are recorded in state file, if upload fails the same
+        stream can be uploaded again and finished parts are skipped
+        Without a state file nothing could resume a failed upload, so it is
+        cancelled and its parts are dropped from swift
+        '''
+        self.connection_factory = connection_factory
+        self.bucket_name = bucket_name
+        self.key_name = key_name
+        self.part_size = int(part_size)
+        self.workers = max(int(workers), 1)
+        self.state_file = state_file
+        self.retries = retries
+
+        self.queue = Queue.Queue(maxsize=self.workers)
+        # One buffer being filled, one per queue slot, one per worker
+        self.buffers = Queue.Queue()
+        for _ in range(buffer_count(self.workers)):
+            self.buffers.put(bytearray(self.part_size))
+        self.lock = threading.Lock()
+        self.upload_id = None
+        self.parts = dict()
+        self.error = None
+
+    def __load_state(self):
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return
+        if state.get('bucket') != self.bucket_name or \
+            state.get('key') != self.key_name or \
+            state.get('part_size') != self.part_size:
+            log.debug('Upload state does not match, starting new upload')
+            return
+        log.debug('Resuming upload:%s, %s parts done' % (state['upload_id'],
+                                                        len(state['parts'])))
+        self.upload_id = state['upload_id']
+        self.parts = state['parts']
+
+    def __save_state(self):
+        if not self.state_file:
+            return
+        state = {'bucket' : self.bucket_name,
+                 'key' : self.key_name,
+                 'part_size' : self.part_size,
+                 'upload_id' : self.upload_id,
+                 'parts' : self.parts}
+        state_dir = os.path.dirname(self.state_file)
+        if state_dir and not os.path.isdir(state_dir):
+            os.makedirs(state_dir, 0700)
+        temp_name = '%s.tmp' % self.state_file
+        with open(temp_name, 'w') as f:
+            json.dump(state, f)
+        os.rename(temp_name, self.state_file)
+
+    def __multipart(self, connection):
+        # Each thread needs its own handle on the upload
+        bucket = connection.get_bucket(self.bucket_name, validate=False)
+        multi_part = MultiPartUpload(bucket)
+        multi_part.key_name = self.key_name
+        multi_part.id = self.upload_id
+        return multi_part
+
+    def __upload_part(self, multi_part, part_num, buff, size):
+        for attempt in range(1, self.retries + 1):
+            try:
+                log.debug('Uploading part:%s, attempt:%s' % (part_num, attempt))
+                f = PartFile(buff, size)
+                try:
+                    key = multi_part.upload_part_from_file(f, part_num,
+                                                           size=size)
+                finally:
+                    f.close()
+                return getattr(key, 'etag', None)
+            except Exception, e:
+                if attempt == self.retries:
+                    raise
+                log.error('Error uploading part:%s, %s' % (part_num, str(e)))
+                time.sleep(2 ** attempt)
+
+    def __worker(self):
+        multi_part = None
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                part_num, buff, size = item
+                # Keep draining queue after an error so reader never blocks
+                if self.error:
+                    self.buffers.put(buff)
+                    continue
+                try:
+                    if not multi_part:
+                        multi_part = self.__multipart(self.connection_factory())
+                    etag = self.__upload_part(multi_part, part_num, buff, size)
+                except Exception, e:
+                    log.exception('Cannot upload part:%s' % part_num)
+                    self.error = e
+                    continue
+                finally:
+                    self.buffers.put(buff)
+                with self.lock:
+                    self.parts[str(part_num)] = etag
+                    self.__save_state()
+            finally:
+                self.queue.task_done()
+
+    def __put(self, item):
+        # Do not block forever if workers have stopped taking parts
+        while not self.error:
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                continue
+
+    def __split(self, chunks):
+        # Copy chunks into part buffers, yield (buffer, size) for full parts
+        # Caller has to put buffer back in pool once it is done with it
+        buff = self.buffers.get()
+        size = 0
+        for chunk in chunks:
+            chunk = memoryview(chunk)
+            while len(chunk):
+                length = min(len(chunk), self.part_size - size)
+                buff[size:size + length] = chunk[:length]
+                size += length
+                chunk = chunk[length:]
+                if size == self.part_size:
+                    yield buff, size
+                    buff = self.buffers.get()
+                    size = 0
+        if size:
+            yield buff, size
+        else:
+            self.buffers.put(buff)
+
+    def __cancel(self, connection):
+        log.error('Cancelling multipart upload:%s' % self.upload_id)
+        try:
+            self.__multipart(connection).cancel_upload()
+        except Exception, e:
+            log.error('Cannot cancel upload:%s, %s' % (self.upload_id, str(e)))
+
+    def upload(self, chunks, metadata=None):
+        '''
+        Upload iterable of data chunks, return key name
+        Raise the part upload error if any part could not be uploaded
+        '''
+        connection = self.connection_factory()
+        self.__load_state()
+        if not self.upload_id:
+            bucket = connection.get_bucket(self.bucket_name)
+            multi_part = bucket.initiate_multipart_upload(self.key_name,
+                                                          metadata=metadata)
+            self.upload_id = multi_part.id
+            log.debug('Started multipart upload:%s' % self.upload_id)
+            self.__save_state()
+        threads = []
+        for _ in range(self.workers):
+            t = threading.Thread(target=self.__worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        part_num = 0
+        try:
+            for buff, size in self.__split(chunks):
+                part_num += 1
+                if self.error:
+                    break
+                if str(part_num) in self.parts:
+                    log.debug('Part:%s already uploaded, skipping' % part_num)
+                    self.buffers.put(buff)
+                    continue
+                self.__put((part_num, buff, size))
+        finally:
+            for _ in threads:
+                self.queue.put(None)
+            for t in threads:
+                t.join()
+        if self.error:
+            if self.state_file:
+                log.error('Upload:%s not finished, state kept in:%s' %
+                          (self.upload_id, self.state_file))
+            else:
+                self.__cancel(connection)
+            raise self.error
+        log.debug('Completing multipart upload:%s, %s parts' % (self.upload_id,
+                                                                part_num))
+        self.__multipart(connection).complete_upload()
+        if self.state_file and os.path.exists(self.state_file):
+            os.remove(self.state_file)
+        return self.key_name
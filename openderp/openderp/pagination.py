@@ -0,0 +1,81 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+# Images fetched per glance request
+IMAGE_PAGE_SIZE = 1000
+# Volumes and servers fetched per request
+PAGE_SIZE = 1000
+
+def iter_images(glance, page_size=IMAGE_PAGE_SIZE, **kwargs):
+    '''
+    Lazily yield every image in glance once, public and private, in one
+    paginated scan of page size images per request
+    '''
+    seen = set()
+    for image in glance.images.list(is_public=None, page_size=page_size,
+                                    **kwargs):
+        # Pages can shift while listing, do not count an image twice
+        if image.id in seen:
+            continue
+        seen.add(image.id)
+        yield image
+    log.debug('Listed %s images' % len(seen))
+
+def iter_paged(list_page, page_size=PAGE_SIZE):
+    '''
+    Lazily yield every resource from list_page(marker=, limit=), asking for
+    page size resources at a time after the id of the last one seen
+    Paging stops at an empty page, since a server capping pages below
+    page size returns short pages before the last one
+    An api that ignores limit gives everything in the first page, an api
+    that ignores marker is listed again without paging
+    '''
+    seen = set()
+    marker = None
+    while True:
+        page = list_page(marker=marker, limit=page_size)
+        new = [r for r in page if r.id not in seen]
+        if marker and page and not new:
+            log.warn('Api ignored marker:%s, listing without paging' % marker)
+            for resource in list_page(marker=None, limit=None):
+                if resource.id not in seen:
+                    seen.add(resource.id)
+                    yield resource
+            return
+        for resource in new:
+            seen.add(resource.id)
+            yield resource
+        # Long page means limit was ignored and everything was listed
+        if not page or len(page) > page_size:
+            break
+        marker = page[-1].id
+    log.debug('Listed %s resources' % len(seen))
+
+def iter_offset_paged(list_page, page_size=PAGE_SIZE):
+    '''
+    Lazily yield every resource from list_page(offset=, limit=), asking for
+    page size resources at a time after the ones already listed
+    For apis that page by offset instead of marker, like cinder v1
+    Paging stops at an empty page, same as iter_paged
+    '''
+    seen = set()
+    offset = 0
+    while True:
+        page = list_page(offset=offset, limit=page_size)
+        new = [r for r in page if r.id not in seen]
+        if offset and page and not new:
+            log.warn('Api ignored offset:%s, listing without paging' % offset)
+            for resource in list_page(offset=None, limit=None):
+                if resource.id not in seen:
+                    seen.add(resource.id)
+                    yield resource
+            return
+        for resource in new:
+            seen.add(resource.id)
+            yield resource
+        # Long page means limit was ignored and everything was listed
+        if not page or len(page) > page_size:
+            break
+        offset += len(page)
+    log.debug('Listed %s resources' % len(seen))
@@ -0,0 +1,179 @@
+from copy import deepcopy
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Poll settings in seconds for each type of resource
+# Interval starts at initial and grows after every poll up to maximum
+WAIT_DEFAULTS = {
+    'server' : {'initial' : 1, 'maximum' : 15, 'timeout' : 3600},
+    'volume' : {'initial' : 1, 'maximum' : 10, 'timeout' : 3600},
+    'snapshot' : {'initial' : 2, 'maximum' : 20, 'timeout' : 3600},
+    'image' : {'initial' : 2, 'maximum' : 30, 'timeout' : 3600},
+}
+# Interval is multiplied by this after every poll
+BACKOFF = 1.5
+# Random fraction of interval added or removed so pollers do not line up
+JITTER = 0.2
+
+class Waiter(object):
+    def __init__(self, defaults=None):
+        '''
+        Wait for resources to reach a status, polling fast at first and
+        backing off with jitter the longer a resource takes
+        Timing of every wait is kept in metrics
+        '''
+        self.defaults = deepcopy(WAIT_DEFAULTS)
+        if defaults:
+            for resource, settings in defaults.iteritems():
+                self.defaults.setdefault(resource, dict()).update(settings)
+        self.metrics = []
+
+    def intervals(self, resource):
+        '''Generate sleep intervals for resource type'''
+        settings = self.defaults[resource]
+        interval = settings['initial']
+        while True:
+            yield interval * random.uniform(1 - JITTER, 1 + JITTER)
+            interval = min(interval * BACKOFF, settings['maximum'])
+
+    def record(self, resource, obj_id, status, polls, start):
+        seconds = round(time.time() - start, 3)
+        log.debug('Waited %s seconds for %s:%s, %s polls, status:%s' %
+                  (seconds, resource, obj_id, polls, status))
+        self.metrics.append({'resource' : resource, 'id' : obj_id,
+                             'status' : status, 'polls' : polls,
+                             'seconds' : seconds})
+
+    def wait_for(self, obj_id, function, whitelist, blacklist=None,
+                 resource='volume', timeout=None):
+        '''
+        Poll function(obj_id) until status is in whitelist, return obj id
+        Return None if status is in blacklist or timeout is reached
+        '''
+        blacklist = blacklist or []
+        if timeout is None:
+            timeout = self.defaults[resource]['timeout']
+        start = time.time()
+        intervals = self.intervals(resource)
+        result = None
+        obj = function(obj_id)
+        polls = 1
+        while True:
+            if obj.status in whitelist:
+                result = obj.id
+                break
+            if obj.status in blacklist:
+                break
+            remaining = start + timeout - time.time()
+            if remaining <= 0:
+                log.error('Timed out waiting for %s:%s' % (resource, obj_id))
+                break
+            time.sleep(min(next(intervals), remaining))
+            obj = function(obj_id)
+            polls += 1
+        self.record(resource, obj_id, obj.status, polls, start)
+        return result
+
+class BatchWaiter(object):
+    def __init__(self, list_function, resource='volume', defaults=None):
+        '''
+        Wait for many resources of one type with a single list call per poll
+        Safe to share between threads, only one thread polls at a time and
+        all waiting threads are resolved from the same list
+        '''
+        self.list_function = list_function
+        self.resource = resource
+        self.settings = dict(WAIT_DEFAULTS[resource])
+        if defaults:
+            self.settings.update(defaults)
+        self.condition = threading.Condition()
+        self.statuses = dict()
+        self.statuses_time = 0
+        self.polling = False
+        self.next_poll = 0
+        self.interval = self.settings['initial']
+        self.polls = 0
+        self.metrics = []
+
+    def __poll(self):
+        # Called with condition held, released while list call is made
+        self.polling = True
+        started = time.time()
+        self.condition.release()
+        try:
+            statuses = dict((obj.id, obj.status) for obj in self.list_function())
+        finally:
+            self.condition.acquire()
+            self.polling = False
+            # Wake waiters on error too, one of them polls again
+            self.condition.notify_all()
+        self.polls += 1
+        self.statuses = statuses
+        self.statuses_time = started
+        interval = self.interval * random.uniform(1 - JITTER, 1 + JITTER)
+        self.next_poll = time.time() + interval
+        self.interval = min(self.interval * BACKOFF, self.settings['maximum'])
+
+    def wait_for_all(self, obj_ids, whitelist, blacklist=None, timeout=None):
+        '''
+        Wait for every id to reach a status in whitelist
+        Return dict of id to id, or None if blacklisted or timed out
+        '''
+        blacklist = blacklist or []
+        if timeout is None:
+            timeout = self.settings['timeout']
+        start = time.time()
+        pending = set(obj_ids)
+        results = dict()
+        with self.condition:
+            # New resources get fast polls again
+            self.interval = self.settings['initial']
+            self.next_poll = min(self.next_poll, start)
+            first_poll = self.polls
+            while pending:
+                now = time.time()
+                remaining = start + timeout - now
+                if remaining <= 0:
+                    log.error('Timed out waiting for %s:%s' % (self.resource,
+                                                              list(pending)))
+                    for obj_id in pending:
+                        results[obj_id] = None
+                    break
+                if self.polling:
+                    self.condition.wait(remaining)
+                elif self.next_poll > now:
+                    self.condition.wait(min(self.next_poll - now, remaining))
+                else:
+                    self.__poll()
+                # Only trust polls started after this wait began
+                if self.statuses_time < start:
+                    continue
+                for obj_id in list(pending):
+                    status = self.statuses.get(obj_id)
+                    if status in whitelist:
+                        results[obj_id] = obj_id
+                    elif status in blacklist:
+                        results[obj_id] = None
+                    else:
+                        continue
+                    pending.remove(obj_id)
+                    self.__record(obj_id, status, start, first_poll)
+        return results
+
+    def __record(self, obj_id, status, start, first_poll):
+        seconds = round(time.time() - start, 3)
+        polls = self.polls - first_poll
+        log.debug('Waited %s seconds for %s:%s, %s list polls, status:%s' %
+                  (seconds, self.resource, obj_id, polls, status))
+        self.metrics.append({'resource' : self.resource, 'id' : obj_id,
+                             'status' : status, 'polls' : polls,
+                             'seconds' : seconds})
+
+    def wait_for(self, obj_id, whitelist, blacklist=None, timeout=None):
+        '''Wait for a single id, return id or None like Waiter.wait_for'''
+        return self.wait_for_all([obj_id], whitelist, blacklist=blacklist,
+                                 timeout=timeout)[obj_id]
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+import setuptools
+
+VERSION = '0.1'
+
+setuptools.setup(
+    author='Tyler Daniel North',
+    author_email='ty_north@yahoo.com',
+    description='Code Shared By The OpenDerp OpenStack Clients',
+    install_requires=[
+        'python-keystoneclient >= 0.9.0',
+    ],
+    packages=[
+        'openderp'
+    ],
+    name='openderp',
+    version=VERSION,
+)
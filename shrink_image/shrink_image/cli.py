@@ -3,6 +3,7 @@
 import argparse
 import logging
 import os
+from openderp.auth import invalidate_token, unauthorized
 from shrink_image.client import ShrinkImage
 import sys
 
@@ -14,6 +15,10 @@ handle.setLevel(logging.DEBUG)
 form = logging.Formatter(log_format)
 handle.setFormatter(form)
 log.addHandler(handle)
+# Shared code logs under its own package
+shared_log = logging.getLogger('openderp')
+shared_log.setLevel(logging.DEBUG)
+shared_log.addHandler(handle)
 
 def parse_args():
     p = argparse.ArgumentParser(description='Manage Boot From Volume Instances')
@@ -26,6 +31,12 @@ def parse_args():
     p.add_argument('--name', help='Image name')
     p.add_argument('--all', action='store_true',
                    help='Convert all images')
+    p.add_argument('--workers', type=int, default=1,
+                   help='Number of images to convert at once with --all')
+    p.add_argument('--max-gigabytes', type=int,
+                   help='Max GB of temp volumes at once with --all')
+    p.add_argument('--min-size', type=int, default=0,
+                   help='Skip images smaller than this many MB with --all')
 
     return p.parse_args()
 
@@ -45,17 +56,29 @@ def get_env_args(args):
             sys.exit("Don't have:%s, exiting" % item)
     return args
 
-def main():
-    args = vars(parse_args())
-    args = get_env_args(args)
-
+def run(args):
     s = ShrinkImage(args['username'], args['password'], args['tenant_name'],
                     args['auth_url'])
     if args['all']:
-        s.shrink_all_images()
+        s.shrink_all_images(workers=args['workers'],
+                            max_gigabytes=args['max_gigabytes'],
+                            min_size=args['min_size'] * 1024 * 1024)
         return
     if args['image_id']:
         s.shrink_image(args['image_id'], image_name=args['name'])
 
+def main():
+    args = get_env_args(vars(parse_args()))
+    try:
+        run(args)
+    except Exception, e:
+        if not unauthorized(e):
+            raise
+        # Cached token revoked before it expired, run once more with a new one
+        log.error('Token refused, authenticating again:%s' % str(e))
+        invalidate_token(args['auth_url'], args['username'], args['tenant_name'],
+                         args['password'])
+        run(args)
+
 if __name__ == '__main__':
     main()
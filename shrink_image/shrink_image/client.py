@@ -1,71 +1,113 @@
 from contextlib import contextmanager
-from cinderclient.v1 import client as cinder_v1
-from glanceclient import Client as glance_client
-from keystoneclient.v2_0 import client as key_v2
+from datetime import datetime, timedelta
 import logging
 import math
+import os
 import random
 import string
-import time
+
+from openderp.auth import CACHE_DIR, CachedAuth, cache_key
+from openderp.pagination import IMAGE_PAGE_SIZE, iter_images
+from openderp.waiter import BatchWaiter, Waiter
+
+from shrink_image.scheduler import ConversionScheduler
 
 log = logging.getLogger(__name__)
 
+# Every temp volume gets this name, so batch polls only list temp volumes
+TEMP_VOLUME_NAME = 'shrink-image-temp'
+# Batch polls list images changed this many seconds before the client was
+# made, covers clock skew between us and glance
+CHANGES_SINCE_OVERLAP = 300
+
+def converted_name(image):
+    '''Name given to converted copy of image'''
+    return '%s-converted' % image.name
+
 class ShrinkImage(object):
     def __init__(self, username, password, tenant_name, auth_url):
-        self.keystone = key_v2.Client(username=username,
-                                      password=password,
-                                      tenant_name=tenant_name,
-                                      auth_url=auth_url)
-        image_url = self.keystone.service_catalog.url_for(service_type='image')
-        self.glance = glance_client('1', endpoint=image_url,
-                                    token=self.keystone.auth_token)
-        self.cinder = cinder_v1.Client(username, password,
-                                       tenant_name, auth_url)
+        # Authenticate once, all clients share the same token
+        self.auth = CachedAuth(username, password, tenant_name, auth_url)
+        # Progress of shrink all images, per set of credentials
+        self.state_file = os.path.join(CACHE_DIR, 'shrink-%s.json' %
+                                       cache_key(auth_url, username, tenant_name))
+        self.keystone = self.auth.keystone
+        self.__glance = self.auth.glance_client()
+        self.cinder = self.auth.cinder_client()
+        self.waiter = Waiter()
+        # Shared by concurrent conversions, one list call per poll for all
+        # Polls only list temp volumes and images changed since client made,
+        # not every volume and image in the cloud
+        since = datetime.utcnow() - timedelta(seconds=CHANGES_SINCE_OVERLAP)
+        self.changes_since = since.strftime('%Y-%m-%dT%H:%M:%SZ')
+        self.volume_waiter = BatchWaiter(self.__temp_volumes, 'volume')
+        self.image_waiter = BatchWaiter(self.__new_images, 'image')
+
+    @property
+    def glance(self):
+        # Glance only has the token, make it again when token is renewed
+        if self.auth.refresh():
+            self.__glance = self.auth.glance_client()
+        return self.__glance
+
+    def __temp_volumes(self):
+        return self.cinder.volumes.list(search_opts={'display_name' :
+                                                     TEMP_VOLUME_NAME})
+
+    def __new_images(self):
+        return iter_images(self.glance,
+                           filters={'changes-since' : self.changes_since})
+
+    def __wait_for_volume(self, volume_id, batch=False):
+        if batch:
+            return self.volume_waiter.wait_for(volume_id, ['available'],
+                                               blacklist=['error'])
+        return self.waiter.wait_for(volume_id, self.cinder.volumes.get,
+                                    ['available'], blacklist=['error'],
+                                    resource='volume')
+
+    def __wait_for_image(self, image_id, batch=False):
+        if batch:
+            return self.image_waiter.wait_for(image_id, ['active'],
+                                              blacklist=['error'])
+        # Look glance up every poll, token can be renewed while waiting
+        return self.waiter.wait_for(image_id, lambda i: self.glance.images.get(i),
+                                    ['active'], blacklist=['error'],
+                                    resource='image')
 
     def __random_string(self, prefix='', length=10):
         chars = string.ascii_lowercase + string.digits
         s = ''.join(random.choice(chars) for _ in range(length))
         return prefix + s
 
-    def __wait_for(self, obj_id, function, whitelist, blacklist=[],
-                   interval=5, timeout=3600):
-        timeout = time.time() + timeout
-        obj = function(obj_id)
-        while obj.status not in whitelist:
-            if time.time() >= timeout:
-                return None
-            if obj.status in blacklist:
-                return None
-            time.sleep(interval)
-            obj = function(obj_id)
-        return obj.id
-
     @contextmanager
-    def __temp_volume(self, image_id):
+    def __temp_volume(self, image_id, batch=False):
         log.debug('Creating volume from image:%s' % image_id)
         image = self.glance.images.get(image_id)
         size = math.ceil(image.size / (1024*1024*1024.0))
-        vol = self.cinder.volumes.create(size, imageRef=image_id)
+        vol = self.cinder.volumes.create(size, imageRef=image_id,
+                                         display_name=TEMP_VOLUME_NAME)
         log.debug('Volume created:%s' % vol.id)
-        result = self.__wait_for(vol.id, self.cinder.volumes.get,
-                                 ['available'], blacklist=['error'])
+        result = self.__wait_for_volume(vol.id, batch=batch)
         try:
             yield result
         finally:
-            self.__wait_for(vol.id, self.cinder.volumes.get,
-                            ['available'], blacklist=['error'])
+            self.__wait_for_volume(vol.id, batch=batch)
             self.cinder.volumes.delete(vol.id)
 
-    def shrink_image(self, image_id, image_name=None):
+    def shrink_image(self, image_id, image_name=None, batch=False):
+        # With batch, waits go through the shared list based waiters,
+        # use when running many conversions at once
         log.debug('Converting image:%s' % image_id)
         result = None
+        source_id = image_id
         image = self.glance.images.get(image_id)
         min_size = int(math.ceil(image.size / (1024*1024*1024.0)))
         project_id = image.owner
         if image.disk_format == 'qcow2':
             log.error('Cannot shrink image, is already qcow2')
             return
-        with self.__temp_volume(image_id) as volume:
+        with self.__temp_volume(image_id, batch=batch) as volume:
             if not volume:
                 log.error('Error creating volume')
                 return
@@ -79,25 +121,53 @@ class ShrinkImage(object):
                                                              'qcow2')
             image_id = image_info[1]['os-volume_upload_image']['image_id']
         log.debug('Image created:%s' % image_id)
-        result = self.__wait_for(image_id, self.glance.images.get,
-                                 ['active'], blacklist=['error'])
+        result = self.__wait_for_image(image_id, batch=batch)
         log.debug('Min size updated:%s' % min_size)
         self.glance.images.update(image_id, min_disk=min_size)
         log.debug('Updating owner to original project:%s' % project_id)
         self.glance.images.update(image_id, owner=project_id)
+        if result:
+            # Record conversion on both images so later runs can skip them
+            log.debug('Marking image:%s shrunk to:%s' % (source_id, result))
+            self.glance.images.update(result, purge_props=False,
+                                      properties={'shrunk_from' : source_id})
+            self.glance.images.update(source_id, purge_props=False,
+                                      properties={'shrunk_to' : result})
         return result
 
-    def shrink_all_images(self):
-        images_converted = set([])
-        for image in self.glance.images.list(is_public=False):
-            if not image.id in images_converted:
-                new_image = self.shrink_image(image.id, image_name=image.name + '-converted')
-                if new_image:
-                    images_converted.add(new_image)
-            images_converted.add(image.id)
-        for image in self.glance.images.list(is_public=True):
-            if not image.id in images_converted:
-                new_image = self.shrink_image(image.id, image_name=image.name + '-converted')
-                if new_image:
-                    images_converted.add(new_image)
-            images_converted.add(image.id)
+    def __needs_shrink(self, image, min_size, names):
+        if image.disk_format == 'qcow2':
+            return False
+        properties = getattr(image, 'properties', {})
+        if 'shrunk_to' in properties or 'shrunk_from' in properties:
+            log.debug('Image:%s already converted, skipping' % image.id)
+            return False
+        # Converted before conversions were marked on images
+        if converted_name(image) in names:
+            log.debug('Image:%s has converted image:%s, skipping' %
+                      (image.id, converted_name(image)))
+            return False
+        if image.size < min_size:
+            log.debug('Image:%s under %s bytes, skipping' % (image.id, min_size))
+            return False
+        return True
+
+    def shrink_all_images(self, workers=1, max_gigabytes=None,
+                          page_size=IMAGE_PAGE_SIZE, min_size=0):
+        # Convert up to workers images at once, smallest first, keeping temp
+        # volumes under max gigabytes. Progress is saved in state file so a
+        # run that stops part way resumes where it was
+        # Images already converted, or smaller than min size bytes, skipped
+        images = list(iter_images(self.glance, page_size=page_size))
+        names = set(i.name for i in images)
+        candidates = [i for i in images
+                      if self.__needs_shrink(i, min_size, names)]
+        log.debug('Found %s images to convert' % len(candidates))
+        def convert(image):
+            return self.shrink_image(image.id,
+                                     image_name=converted_name(image),
+                                     batch=workers > 1)
+        scheduler = ConversionScheduler(convert, workers=workers,
+                                        max_gigabytes=max_gigabytes,
+                                        state_file=self.state_file)
+        return scheduler.run(candidates)
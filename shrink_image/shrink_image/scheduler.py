@@ -0,0 +1,116 @@
+import json
+import logging
+import math
+import os
+import Queue
+import threading
+
+log = logging.getLogger(__name__)
+
+def image_gigabytes(image):
+    '''Size of volume needed to hold image'''
+    return int(math.ceil(image.size / (1024*1024*1024.0)))
+
+class ConversionScheduler(object):
+    def __init__(self, convert, workers=1, max_gigabytes=None,
+                 state_file=None):
+        '''
+        Run convert(image) for many images at once
+        Images are started smallest first, no more than workers at a time,
+        and only while their temp volumes fit under max gigabytes
+        Finished images are written to state file, so a new run with the
+        same file skips them and resumes with the rest
+        '''
+        self.convert = convert
+        self.workers = max(int(workers), 1)
+        self.max_gigabytes = max_gigabytes
+        self.state_file = state_file
+
+        self.condition = threading.Condition()
+        self.gigabytes = 0
+        self.done = dict()
+        self.failed = []
+
+    def __load_state(self):
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file, 'r') as f:
+                self.done = json.load(f)['done']
+            log.debug('Loaded %s finished conversions from:%s' % (len(self.done),
+                                                                 self.state_file))
+        except (IOError, KeyError, ValueError):
+            self.done = dict()
+
+    def __save_state(self):
+        # Called with condition held
+        if not self.state_file:
+            return
+        state_dir = os.path.dirname(self.state_file)
+        if state_dir and not os.path.isdir(state_dir):
+            os.makedirs(state_dir, 0700)
+        temp_name = '%s.tmp' % self.state_file
+        with open(temp_name, 'w') as f:
+            json.dump({'done' : self.done}, f)
+        os.rename(temp_name, self.state_file)
+
+    def __acquire(self, gigabytes):
+        with self.condition:
+            # Image larger than limit still runs, but only on its own
+            while self.max_gigabytes and self.gigabytes and \
+                self.gigabytes + gigabytes > self.max_gigabytes:
+                self.condition.wait()
+            self.gigabytes += gigabytes
+
+    def __release(self, gigabytes):
+        with self.condition:
+            self.gigabytes -= gigabytes
+            self.condition.notify_all()
+
+    def __worker(self, queue):
+        while True:
+            try:
+                image = queue.get_nowait()
+            except Queue.Empty:
+                return
+            gigabytes = image_gigabytes(image)
+            self.__acquire(gigabytes)
+            try:
+                log.debug('Starting conversion of image:%s, %s GB in use' %
+                          (image.id, self.gigabytes))
+                result = self.convert(image)
+            except Exception:
+                log.exception('Error converting image:%s' % image.id)
+                result = None
+            finally:
+                self.__release(gigabytes)
+            with self.condition:
+                if result:
+                    self.done[image.id] = result
+                    self.__save_state()
+                else:
+                    self.failed.append(image.id)
+
+    def run(self, images):
+        '''
+        Convert images, return dict of image id to converted image id
+        Failed images are kept in failed and tried again on next run
+        '''
+        self.__load_state()
+        queue = Queue.Queue()
+        todo = [i for i in images if i.id not in self.done]
+        log.debug('Converting %s images, %s already done' % (len(todo),
+                                                            len(self.done)))
+        for image in sorted(todo, key=lambda i: i.size):
+            queue.put(image)
+        threads = []
+        for _ in range(min(self.workers, len(todo))):
+            t = threading.Thread(target=self.__worker, args=(queue,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        if self.failed:
+            log.error('Conversion failed for images:%s' % self.failed)
+        return self.done
@@ -9,6 +9,7 @@ setuptools.setup(
     description='OpenStack Bootable Volume',
     install_requires=[
         'boto >= 2.32.0',
+        'openderp >= 0.1',
         'python-cinderclient >= 1.0.9',
         'python-glanceclient >= 0.13.1',
         'python-keystoneclient >= 0.10.1',
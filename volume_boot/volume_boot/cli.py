@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+from openderp.auth import invalidate_token, unauthorized
 from volume_boot.client import VolumeBoot
 import argparse
 import logging
@@ -14,6 +15,10 @@ handle.setLevel(logging.DEBUG)
 form = logging.Formatter(log_format)
 handle.setFormatter(form)
 log.addHandler(handle)
+# Shared code logs under its own package
+shared_log = logging.getLogger('openderp')
+shared_log.setLevel(logging.DEBUG)
+shared_log.addHandler(handle)
 
 
 def parse_args():
@@ -50,12 +55,26 @@ def parse_args():
     backup.add_argument('instance', help='ID of instance')
     backup.add_argument('--max', default=0, type=int,
                         help='Maximum number of backups')
+    backup.add_argument('--daily', default=0, type=int,
+                        help='Also keep newest backup of this many days')
+    backup.add_argument('--weekly', default=0, type=int,
+                        help='Also keep newest backup of this many weeks')
     backup.add_argument('--swift', action='store_true',
                         help='Convert image to swift')
     backup.add_argument('--direct', action='store_true',
                         help='Move directly from glance to swift')
     backup.add_argument('--compress', action='store_true',
-                        help='Compress a swift object')
+                        help='Compress a swift object, with --direct '
+                             'gzip image as it is uploaded')
+    backup.add_argument('--compress-level', default=6, type=int,
+                        choices=range(1, 10),
+                        help='Gzip level for --direct --compress')
+    backup.add_argument('--workers', default=4, type=int,
+                        help='Number of parts to upload at once with --direct')
+    backup.add_argument('--max-memory', type=int,
+                        help='Max MB of memory for parts with --direct')
+    backup.add_argument('--dry-run', action='store_true',
+                        help='Show upload plan for --direct and exit')
     return p.parse_args()
 
 def get_env_args(args):
@@ -74,9 +93,7 @@ def get_env_args(args):
             sys.exit("Don't have:%s, exiting" % item)
     return args
 
-def main():
-    args = vars(parse_args())
-    args = get_env_args(args)
+def run(args):
     v = VolumeBoot(args['username'], args['password'],
                    args['tenant_name'], args['auth_url'])
     if args['command'] == 'boot':
@@ -90,9 +107,39 @@ def main():
     if args['command'] == 'snapshot':
         v.snapshot_instance(args['instance'], image_name=args['name'])
     if args['command'] == 'backup':
-        v.backup_instance(args['instance'], args['max'],
-                          swift=args['swift'], compress=args['compress'],
-                          direct=args['direct'])
+        max_memory = None
+        if args['max_memory']:
+            max_memory = args['max_memory'] * 1024 * 1024
+        try:
+            if args['dry_run']:
+                plan = v.plan_backup(args['instance'], workers=args['workers'],
+                                     max_memory=max_memory,
+                                     compress=args['compress'])
+                if plan:
+                    for key in ['parts', 'part_size', 'workers', 'memory']:
+                        print '%s: %s' % (key, plan[key])
+                return
+            v.backup_instance(args['instance'], args['max'],
+                              swift=args['swift'], compress=args['compress'],
+                              direct=args['direct'], workers=args['workers'],
+                              max_memory=max_memory,
+                              compress_level=args['compress_level'],
+                              daily=args['daily'], weekly=args['weekly'])
+        except ValueError, e:
+            sys.exit('Cannot backup instance:%s' % str(e))
+
+def main():
+    args = get_env_args(vars(parse_args()))
+    try:
+        run(args)
+    except Exception, e:
+        if not unauthorized(e):
+            raise
+        # Cached token revoked before it expired, run once more with a new one
+        log.error('Token refused, authenticating again:%s' % str(e))
+        invalidate_token(args['auth_url'], args['username'], args['tenant_name'],
+                         args['password'])
+        run(args)
 
 if __name__ == '__main__':
     main()
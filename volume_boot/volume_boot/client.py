@@ -1,16 +1,15 @@
 import boto
 from boto.s3 import connection as s3_connection
 from boto.exception import S3ResponseError as s3_error
-from cinderclient.v1 import client as cinder_v1
+from boto.utils import parse_ts
+import calendar
 from contextlib import contextmanager
 from copy import deepcopy
 from datetime import datetime
-from glanceclient import Client as glance_client
-import io
+from glanceclient import exc as glance_exceptions
 import json
-from keystoneclient.v2_0 import client as key_v2
 import logging
-from novaclient.v1_1 import client as nova_v1
+from multiprocessing.pool import ThreadPool
 import os
 import random
 import shlex
@@ -18,60 +17,64 @@ import string
 import subprocess
 import tempfile
 import time
-from urlparse import urlparse
 
+from openderp.auth import CACHE_DIR, CachedAuth, Ec2Cache, ec2_settings
+from openderp.auth import read_cache, write_cache
+from openderp.multipart import MAX_PARTS, MultipartUploader, plan_parts
+from openderp.waiter import Waiter
+
+from volume_boot.compression import DEFAULT_LEVEL, GzipStream
+from volume_boot.retention import select_expired
 
 log = logging.getLogger(__name__)
 
+# Seconds a cached list of instance backups is used before listing again
+BACKUP_CACHE_TTL = 86400
+
 class VolumeBoot(object):
     def __init__(self, username, password, tenant_name, auth_url):
-        self.cinder = cinder_v1.Client(username, password,
-                                       tenant_name, auth_url)
-        self.nova = nova_v1.Client(username, password, tenant_name, auth_url)
-        self.keystone = key_v2.Client(username=username,
-                                      password=password,
-                                      tenant_name=tenant_name,
-                                      auth_url=auth_url)
-        image_url = self.keystone.service_catalog.url_for(service_type='image')
-        self.glance = glance_client('1', token=self.keystone.auth_token,
-                                    endpoint=image_url)
+        # Authenticate once, all clients share the same token
+        self.auth = CachedAuth(username, password, tenant_name, auth_url)
+        self.keystone = self.auth.keystone
+        self.cinder = self.auth.cinder_client()
+        self.nova = self.auth.nova_client()
+        self.__glance = self.auth.glance_client()
+        self.waiter = Waiter()
 
+        self.ec2_cache = Ec2Cache(username, tenant_name, auth_url)
         self.s3 = self.__s3_client()
 
+    @property
+    def glance(self):
+        # Glance only has the token, make it again when token is renewed
+        if self.auth.refresh():
+            self.__glance = self.auth.glance_client()
+        return self.__glance
+
     def __s3_client(self):
-        creds = self.keystone.ec2.list(self.keystone.user_id)
-        if len(creds) == 0:
-            self.keystone.ec2.create(self.keystone.user_id,
-                                     self.keystone.tenant_id)
-            creds = self.keystone.ec2.list(self.keystone.user_id)
-        cred = creds[-1]
-        s3_url = urlparse(self.keystone.service_catalog.url_for(service_type='object-store'))
-        host, port = s3_url.netloc.split(':')
-        return boto.connect_s3(aws_access_key_id=cred.access,
-                               aws_secret_access_key=cred.secret,
-                               host=host,
-                               port=int(port),
+        # Only go to keystone for ec2 creds if not cached from last run
+        settings = self.ec2_cache.get()
+        if not settings:
+            settings = ec2_settings(self.keystone)
+            self.ec2_cache.set(settings)
+        return boto.connect_s3(aws_access_key_id=settings['access'],
+                               aws_secret_access_key=settings['secret'],
+                               host=settings['host'],
+                               port=settings['port'],
                                is_secure=False,
                                calling_format=s3_connection.OrdinaryCallingFormat())
 
+    def __check_forbidden(self, error):
+        # Cached credentials might have been removed from keystone
+        if error.status == 403:
+            log.error('Access denied, removing cached ec2 credentials')
+            self.ec2_cache.invalidate()
+
     def __random_string(self, prefix='', length=10):
         chars = string.ascii_lowercase + string.digits
         s = ''.join(random.choice(chars) for _ in range(length))
         return prefix + s
 
-    def __wait_for(self, obj_id, function, whitelist, blacklist=[],
-                   interval=5, timeout=3600):
-        expected_timeout = time.time() + timeout
-        obj = function(obj_id)
-        while obj.status not in whitelist:
-            if obj.status in blacklist:
-                return None
-            if time.time() >= expected_timeout:
-                return None
-            time.sleep(interval)
-            obj = function(obj_id)
-        return obj.id
-
     def __wait_for_delete(self, obj_id, list_function, interval=5,
                           timeout=3600):
         expected_timeout = time.time() + timeout
@@ -94,13 +97,15 @@ class VolumeBoot(object):
         server = self.nova.servers.create(server_name, image, flavor,
                                           key_name=key_name)
         log.debug('Created server:%s' % server.id)
-        result = self.__wait_for(server.id, self.nova.servers.get,
-                                 ['ACTIVE'], blacklist=['ERROR'])
+        result = self.waiter.wait_for(server.id, self.nova.servers.get,
+                                      ['ACTIVE'], blacklist=['ERROR'],
+                                      resource='server')
         if result:
             log.debug('Powering down temp server for snapshot')
             self.nova.servers.stop(server.id)
-            result = self.__wait_for(server.id, self.nova.servers.get,
-                                     ['SHUTOFF'], blacklist=['ERROR'])
+            result = self.waiter.wait_for(server.id, self.nova.servers.get,
+                                          ['SHUTOFF'], blacklist=['ERROR'],
+                                          resource='server')
         if not result:
             log.error('Error creating instance')
             try:
@@ -114,8 +119,9 @@ class VolumeBoot(object):
         image_name = self.__random_string(prefix='image-')
         image_id = self.nova.servers.create_image(server.id, image_name)
         log.debug('Snapshot created:%s' % image_id)
-        image = self.__wait_for(image_id, self.nova.images.get,
-                                ['ACTIVE'], blacklist=['ERROR'])
+        image = self.waiter.wait_for(image_id, self.nova.images.get,
+                                     ['ACTIVE'], blacklist=['ERROR'],
+                                     resource='image')
         try:
             yield image
         finally:
@@ -130,8 +136,9 @@ class VolumeBoot(object):
                                          imageRef=image_id,
                                          volume_type=volume_type)
         log.debug('Volume created:%s' % vol.id)
-        result = self.__wait_for(vol.id, self.cinder.volumes.get,
-                                 ['available'], blacklist=['error'])
+        result = self.waiter.wait_for(vol.id, self.cinder.volumes.get,
+                                      ['available'], blacklist=['error'],
+                                      resource='volume')
         return result
 
     def __create_instance(self, flavor, image, name, volume, key_name,
@@ -146,8 +153,9 @@ class VolumeBoot(object):
                                           security_groups=security_groups,
                                           key_name=key_name)
         log.debug('Creating instance:%s' % server.id)
-        result = self.__wait_for(server.id, self.nova.servers.get,
-                                 ['ACTIVE'], blacklist=['ERROR'])
+        result = self.waiter.wait_for(server.id, self.nova.servers.get,
+                                      ['ACTIVE'], blacklist=['ERROR'],
+                                      resource='server')
         return result
 
     def boot_from_volume(self, flavor, image, name, size, temp_flavor,
@@ -180,10 +188,11 @@ class VolumeBoot(object):
                 if mappin['device_name'] == 'vda':
                     snapshot = self.cinder.volume_snapshots.get(mappin['snapshot_id'])
                     log.debug('Found volume snapshot:%s' % mappin['snapshot_id'])
-                    self.__wait_for(mappin['snapshot_id'],
-                                    self.cinder.volume_snapshots.get,
-                                    ['available'],
-                                    blacklist=['error'])
+                    self.waiter.wait_for(mappin['snapshot_id'],
+                                         self.cinder.volume_snapshots.get,
+                                         ['available'],
+                                         blacklist=['error'],
+                                         resource='snapshot')
             except KeyError:
                 # Pre icehouse versions have different mappings
                 _snapshot = self.cinder.volume_snapshots.get(mappin['snapshot_id'])
@@ -192,24 +201,27 @@ class VolumeBoot(object):
                     if attach['device'] == 'vda' and instance_id == attach['server_id']:
                         snapshot = self.cinder.volume_snapshots.get(mappin['snapshot_id'])
                         log.debug('Found volume snapshot:%s' % snapshot.id)
-                        self.__wait_for(snapshot.id,
-                                        self.cinder.volume_snapshots.get,
-                                        ['available'],
-                                        blacklist=['error'])
+                        self.waiter.wait_for(snapshot.id,
+                                             self.cinder.volume_snapshots.get,
+                                             ['available'],
+                                             blacklist=['error'],
+                                             resource='snapshot')
                         break
         log.debug('Creating volume from snapshot')
         vol = self.cinder.volumes.create(snapshot.size, snapshot_id=snapshot.id)
         log.debug('Created volume:%s' % vol.id)
-        self.__wait_for(vol.id, self.cinder.volumes.get,
-                        ['available'], blacklist=['error'])
+        self.waiter.wait_for(vol.id, self.cinder.volumes.get,
+                             ['available'], blacklist=['error'],
+                             resource='volume')
         try:
             yield vol
         finally:
             log.debug('Deleting instance snapshot:%s' % snapshot_id)
             self.glance.images.delete(snapshot_id)
             log.debug('Deleting created volume:%s' % vol.id)
-            self.__wait_for(vol.id, self.cinder.volumes.get,
-                            ['available'], blacklist=['error'])
+            self.waiter.wait_for(vol.id, self.cinder.volumes.get,
+                                 ['available'], blacklist=['error'],
+                                 resource='volume')
             self.cinder.volumes.delete(vol.id)
             self.__wait_for_delete(vol.id, self.cinder.volumes.list)
             log.debug('Deleting volume snapshots:%s' % all_snaps)
@@ -228,39 +240,55 @@ class VolumeBoot(object):
                                                              'qcow2')
             image_id = image_info[1]['os-volume_upload_image']['image_id']
             log.debug('Created image:%s' % image_id)
-            self.__wait_for(image_id, self.glance.images.get,
-                            ['active'], blacklist=['error'])
+            # Look glance up every poll, token can be renewed while waiting
+            self.waiter.wait_for(image_id, lambda i: self.glance.images.get(i),
+                                 ['active'], blacklist=['error'],
+                                 resource='image')
         return image_id
 
-    def __delete_old_backups(self, instance_id, max_backups):
-        log.debug('Deleting old backups, %s allowed' % max_backups)
+    def __list_backups(self, instance_id):
+        # Backups of instance as (timestamp, image id), from cache if fresh
+        cache_file = os.path.join(CACHE_DIR, 'backups-%s.json' % instance_id)
+        cached = read_cache(cache_file)
+        if cached and time.time() - cached['refreshed'] < BACKUP_CACHE_TTL:
+            log.debug('Using cached backup list from:%s' % cache_file)
+            return [tuple(b) for b in cached['backups']], cached['refreshed']
+        log.debug('Listing backups of instance:%s' % instance_id)
         backups = []
-        for image in self.glance.images.list():
+        filters = {'properties' : {'backup_instance_id' : instance_id}}
+        for image in self.glance.images.list(filters=filters):
             try:
-                if instance_id == image.properties['backup_instance_id']:
-                    backups.append(image)
+                timestamp = float(image.properties['backup_timestamp'])
             except KeyError:
                 continue
-        num_backups = len(backups)
-        log.debug('Found %s backups, %s are allowed' % (num_backups, max_backups))
-        if num_backups > max_backups:
-            log.debug('Deleting old backups:%s' % backups)
-            delete_amount = num_backups - max_backups
-            delete_backups = []
-            for backup in backups:
-                if len(delete_backups) < delete_amount:
-                    delete_backups.append(backup)
-                    continue
-                delete_index = None
-                for count, deleted in enumerate(delete_backups):
-                    if deleted.properties['backup_timestamp'] > backup.properties['backup_timestamp']:
-                        delete_index = count
-                        break
-                if delete_index:
-                    delete_backups[delete_index] = backup
-            for backup in delete_backups:
-                log.debug('Deleting backup:%s' % backup.id)
-                self.glance.images.delete(backup.id)
+            backups.append((timestamp, image.id))
+        return backups, time.time()
+
+    def __delete_old_backups(self, instance_id, max_backups, daily=0,
+                             weekly=0, workers=4, new_backup=None):
+        log.debug('Deleting old backups, %s allowed' % max_backups)
+        backups, refreshed = self.__list_backups(instance_id)
+        if new_backup and new_backup[1] not in [b[1] for b in backups]:
+            backups.append(new_backup)
+        log.debug('Found %s backups' % len(backups))
+        expired = select_expired(backups, keep_last=max_backups, daily=daily,
+                                 weekly=weekly)
+        def delete(image_id):
+            log.debug('Deleting backup:%s' % image_id)
+            try:
+                self.glance.images.delete(image_id)
+            except glance_exceptions.HTTPNotFound:
+                log.debug('Backup:%s already deleted' % image_id)
+        if expired:
+            pool = ThreadPool(min(workers, len(expired)))
+            try:
+                pool.map(delete, expired)
+            finally:
+                pool.close()
+                pool.join()
+        remaining = [b for b in backups if b[1] not in expired]
+        write_cache(os.path.join(CACHE_DIR, 'backups-%s.json' % instance_id),
+                    {'refreshed' : refreshed, 'backups' : remaining})
 
     def __compress_file(self, file_name):
         log.debug('Compressing file:%s' % file_name)
@@ -298,78 +326,143 @@ class VolumeBoot(object):
                 key.set_contents_from_file(f)
             key.update_metadata(metadata)
 
-    def __convert_directly(self, image_id, bucket, key_name, metadata):
+    def __log_plan(self, size, plan):
+        log.info('Upload plan for %s bytes: %s parts of %s bytes, '
+                 '%s workers, %s bytes of part buffers' % (size,
+                                                          plan['parts'],
+                                                          plan['part_size'],
+                                                          plan['workers'],
+                                                          plan['memory']))
+
+    def __convert_directly(self, image_id, bucket, key_name, metadata,
+                           workers=4, max_memory=None, compress=False,
+                           compress_level=DEFAULT_LEVEL, plan=None):
+        # Every backup is a new image and key, a failed upload can never be
+        # resumed so it is cancelled instead of keeping state
+        # Plan checked before the backup is used if given, it is made from
+        # boot volume size, which image size cannot go over
         if bucket.get_key(key_name):
             bucket.delete_key(key_name)
-        estimated_size = self.glance.images.get(image_id).size * 1.0
+        metadata = dict(metadata or {})
+        estimated_size = self.glance.images.get(image_id).size
         log.debug('Estimated image size:%s' % estimated_size)
-        min_part_size = estimated_size / 1000
-        log.debug('Min part size:%s' % min_part_size)
-        multi_part = bucket.initiate_multipart_upload(key_name)
-        data = None
-        count = 0
-        log.debug('Uploading a 1000 parts')
-        for chunk in self.glance.images.data(image_id, do_checksum=False):
-            if not data:
-                data = chunk
-            else:
-                data += chunk
-            if len(data) >= min_part_size:
-                count += 1
-                f = io.BytesIO(data)
-                log.debug('Uploading part:%s' % count)
-                multi_part.upload_part_from_file(f, count)
-                f.close()
-                data = None
-        log.debug('Completing mutli part upload')
-        multi_part.complete_upload()
-        log.debug('Updating metadata')
-        key = bucket.get_key(key_name)
-        key.update_metadata(metadata)
+        data = self.glance.images.data(image_id, do_checksum=False)
+        plan_size = estimated_size
+        if compress:
+            log.debug('Compressing stream with gzip level:%s' % compress_level)
+            data = GzipStream(data, level=compress_level)
+            metadata.update({'compression' : 'gzip',
+                             'compression_level' : compress_level,
+                             'image_size' : estimated_size})
+            # Data that does not compress grows slightly with gzip
+            plan_size = int(estimated_size * 1.01)
+        if not plan or plan_size > plan['part_size'] * MAX_PARTS:
+            plan = plan_parts(plan_size, workers=workers, max_memory=max_memory)
+            self.__log_plan(plan_size, plan)
+        uploader = MultipartUploader(self.__s3_client, bucket.name, key_name,
+                                     plan['part_size'], workers=plan['workers'])
+        uploader.upload(data, metadata=metadata)
+        if compress:
+            # Not stored on key, changing metadata through s3 copies the
+            # whole object, image_size metadata and object size give ratio
+            log.info('Compressed %s bytes to %s bytes, ratio:%s' % (data.bytes_in,
+                                                                   data.bytes_out,
+                                                                   data.ratio))
 
-    def __convert_to_swift(self, image_id, bucket_name, key_name, metadata=None, compress=False, direct=False):
+    def __convert_to_swift(self, image_id, bucket_name, key_name, metadata=None,
+                           compress=False, direct=False, workers=4,
+                           max_memory=None, compress_level=DEFAULT_LEVEL,
+                           plan=None):
         log.debug('Converting image:%s to swift object' % image_id)
         log.debug('Getting bucket:%s' % bucket_name)
         try:
             bucket = self.s3.get_bucket(bucket_name)
             log.debug('Bucket exists')
-        except s3_error:
+        except s3_error, e:
+            self.__check_forbidden(e)
             log.debug('Creating bucket:%s' % bucket_name)
             bucket = self.s3.create_bucket(bucket_name)
         log.debug('Direct:%s' % direct)
         if direct:
-            self.__convert_directly(image_id, bucket, key_name, metadata)
+            self.__convert_directly(image_id, bucket, key_name, metadata,
+                                    workers=workers, max_memory=max_memory,
+                                    compress=compress,
+                                    compress_level=compress_level, plan=plan)
         else:
             self.__convert_via_file(image_id, bucket, key_name, metadata,
                                     compress=compress)
 
-    def __delete_old_swift(self, max_num, bucket_name):
+    def __delete_old_swift(self, max_num, bucket_name, daily=0, weekly=0,
+                           workers=4):
         bucket = self.s3.get_bucket(bucket_name)
-        keys = bucket.get_all_keys()
-        num_backups = len(keys)
-        log.debug('Found %s backups, %s are allowed' % (num_backups, max_num))
-        if num_backups > max_num:
-            log.debug('Deleting old backups:%s' % keys)
-            delete_amount = num_backups - max_num
-            delete_backups = []
-            for backup in keys:
-                if len(delete_backups) < delete_amount:
-                    delete_backups.append(backup)
-                    continue
-                delete_index = None
-                for count, deleted in enumerate(delete_backups):
-                    if deleted.get_metadata('timestamp') > backup.get_metadata('timestamp'):
-                        delete_index = count
-                        break
-                if delete_index:
-                    delete_backups[delete_index] = backup
-            for backup in delete_backups:
-                log.debug('Deleting backup:%s' % backup)
-                bucket.delete_key(backup.name)
+        # Listing has last modified time of every key, no need to get each
+        backups = []
+        for key in bucket.list():
+            timestamp = calendar.timegm(parse_ts(key.last_modified).timetuple())
+            backups.append((timestamp, key.name))
+        log.debug('Found %s backups' % len(backups))
+        expired = select_expired(backups, keep_last=max_num, daily=daily,
+                                 weekly=weekly)
+        if not expired:
+            return
+        log.debug('Deleting old backups:%s' % expired)
+        try:
+            result = bucket.delete_keys(expired, quiet=True)
+        except s3_error, e:
+            self.__check_forbidden(e)
+            log.debug('Multi object delete failed, deleting keys one at a time:%s' % str(e))
+            def delete(key_name):
+                # Connections are not thread safe, each delete gets its own
+                self.__s3_client().get_bucket(bucket_name, validate=False).delete_key(key_name)
+            pool = ThreadPool(min(workers, len(expired)))
+            try:
+                pool.map(delete, expired)
+            finally:
+                pool.close()
+                pool.join()
+            return
+        for error in result.errors:
+            log.error('Cannot delete backup:%s, %s' % (error.key, error.message))
+
+    def __boot_volume_size(self, server):
+        # Size in bytes of volume instance boots from, upper bound of image size
+        attached = getattr(server, 'os-extended-volumes:volumes_attached', [])
+        volumes = [self.cinder.volumes.get(v['id']) for v in attached]
+        for vol in volumes:
+            for attach in vol.attachments:
+                if attach['device'] in ['vda', '/dev/vda']:
+                    return vol.size * 1024 * 1024 * 1024
+        if volumes:
+            return volumes[0].size * 1024 * 1024 * 1024
+        return None
+
+    def plan_backup(self, instance_id, workers=4, max_memory=None,
+                    compress=False):
+        # Plan direct upload of instance backup without creating anything
+        # Raise ValueError if backup cannot be uploaded within the limits
+        size = self.__boot_volume_size(self.nova.servers.get(instance_id))
+        if not size:
+            log.error('Cannot find boot volume for instance:%s' % instance_id)
+            return None
+        if compress:
+            # Same allowance for gzip growth as the upload itself
+            size = int(size * 1.01)
+        plan = plan_parts(size, workers=workers, max_memory=max_memory)
+        self.__log_plan(size, plan)
+        return plan
 
     def backup_instance(self, instance_id, max_num, swift=True, compress=False,
-                        direct=False):
-        # Check for number of backups
+                        direct=False, workers=4, max_memory=None,
+                        compress_level=DEFAULT_LEVEL, daily=0, weekly=0):
+        # With direct and compress, image is gzip compressed as it streams
+        # from glance, otherwise file is compressed to qcow2 with qemu-img
+        # Old backups are pruned if max num, daily or weekly are given
+        plan = None
+        if swift and direct:
+            # Fail before snapshotting, not after with a snapshot left behind
+            # Upload uses the same plan, so it matches what dry run shows
+            plan = self.plan_backup(instance_id, workers=workers,
+                                    max_memory=max_memory, compress=compress)
         instance_name = self.nova.servers.get(instance_id).name
         image_name = '%s-%s' % (instance_name, datetime.utcnow())
         backup_image = self.snapshot_instance(instance_id, image_name=image_name)
@@ -379,12 +472,20 @@ class VolumeBoot(object):
         if swift:
             bucket_name = 'instance-%s-backups' % instance_id
             key_name = 'backup-%s' % datetime.utcnow()
+            if direct and compress:
+                key_name += '.gz'
             metadata = {'timestamp' : time.time()}
             self.__convert_to_swift(backup_image, bucket_name, key_name,
                                     metadata=metadata, compress=compress,
-                                    direct=direct)
+                                    direct=direct, workers=workers,
+                                    max_memory=max_memory,
+                                    compress_level=compress_level, plan=plan)
             self.glance.images.delete(backup_image)
-            if max_num:
-                self.__delete_old_swift(max_num, bucket_name)
-        elif max_num:
-            self.__delete_old_backups(instance_id, max_num)
+            if max_num or daily or weekly:
+                self.__delete_old_swift(max_num, bucket_name, daily=daily,
+                                        weekly=weekly, workers=workers)
+        elif max_num or daily or weekly:
+            self.__delete_old_backups(instance_id, max_num, daily=daily,
+                                      weekly=weekly, workers=workers,
+                                      new_backup=(metadata['backup_timestamp'],
+                                                  backup_image))
@@ -0,0 +1,35 @@
+import zlib
+
+# Default gzip level for streamed backups
+DEFAULT_LEVEL = 6
+
+class GzipStream(object):
+    def __init__(self, chunks, level=DEFAULT_LEVEL):
+        '''
+        Gzip compress an iterable of data chunks as it is read
+        Counts bytes in and out so ratio is known once stream is done
+        '''
+        self.chunks = chunks
+        self.level = level
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __iter__(self):
+        # Window bits over 16 makes zlib write gzip header and trailer
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        for chunk in self.chunks:
+            self.bytes_in += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                self.bytes_out += len(data)
+                yield data
+        data = compressor.flush()
+        self.bytes_out += len(data)
+        yield data
+
+    @property
+    def ratio(self):
+        if not self.bytes_out:
+            return None
+        return round(self.bytes_in * 1.0 / self.bytes_out, 3)
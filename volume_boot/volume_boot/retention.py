@@ -0,0 +1,38 @@
+from datetime import datetime
+import heapq
+import logging
+
+log = logging.getLogger(__name__)
+
+def select_expired(backups, keep_last=0, daily=0, weekly=0):
+    '''
+    Pick backups to delete from list of (timestamp, backup) tuples
+    Newest keep last backups are kept, along with the newest backup of each
+    of the last daily days and weekly weeks that have backups
+    Return expired backups, oldest first
+    '''
+    if not daily and not weekly:
+        # Only need newest keep last, no need to sort everything
+        kept = heapq.nlargest(keep_last, backups, key=lambda b: b[0])
+        kept_ids = set(id(b) for b in kept)
+    else:
+        kept_ids = set()
+        days = set()
+        weeks = set()
+        newest_first = sorted(backups, key=lambda b: b[0], reverse=True)
+        for count, backup in enumerate(newest_first):
+            date = datetime.utcfromtimestamp(backup[0]).date()
+            week = date.isocalendar()[:2]
+            if count < keep_last:
+                kept_ids.add(id(backup))
+            if date not in days and len(days) < daily:
+                days.add(date)
+                kept_ids.add(id(backup))
+            if week not in weeks and len(weeks) < weekly:
+                weeks.add(week)
+                kept_ids.add(id(backup))
+    expired = [b for b in backups if id(b) not in kept_ids]
+    expired.sort(key=lambda b: b[0])
+    log.debug('Keeping %s backups, %s expired' % (len(backups) - len(expired),
+                                                 len(expired)))
+    return [b[1] for b in expired]